@@ -17,11 +17,23 @@
 import sys
 import os
 import csv
+import json
+import time
 import codecs
+import hashlib
+import itertools
+import jarray
+from java.io import File, FileOutputStream, BufferedOutputStream
+from java.lang import String, Runtime
+from java.lang import Exception as JavaException
+from java.util.concurrent import Executors, Callable
+from java.nio import ByteBuffer, ByteOrder
+from java.util.zip import ZipOutputStream, ZipEntry
 from ij import IJ
 from fiji.plugin.trackmate import Model, Settings, TrackMate, Logger
 from fiji.plugin.trackmate.detection import LogDetectorFactory, DogDetectorFactory
 from fiji.plugin.trackmate.tracking.jaqaman import SparseLAPTrackerFactory
+from fiji.plugin.trackmate.io import TmXmlReader, TmXmlWriter
 from fiji.plugin.trackmate.gui.displaysettings import DisplaySettingsIO
 from fiji.plugin.trackmate.gui.displaysettings.DisplaySettings import TrackMateObject
 from fiji.plugin.trackmate.features.track import TrackIndexAnalyzer
@@ -33,10 +45,22 @@ reload(sys)
 sys.setdefaultencoding('utf-8')
 
 
-def run_trackmate_on_image(imp, detector='Log', spot_filters=[], display_spot=True, display_track=True):
-    model = Model()
-    model.setLogger(Logger.IJ_LOGGER)
+class TrackMateError(Exception):
+    pass
+
+
+DETECTOR_SETTINGS = {
+    'DO_SUBPIXEL_LOCALIZATION': True,
+    'RADIUS': 0.15,
+    'TARGET_CHANNEL': 1,
+    'THRESHOLD': 1.0,
+    'DO_MEDIAN_FILTERING': True,
+}
 
+
+def make_settings(imp, detector='Log', spot_filters=[], tracker_overrides=None):
+    # TrackMate settings for one image; tracker_overrides replaces individual
+    # tracker settings (e.g. {'LINKING_MAX_DISTANCE': 0.2}) for sweeps
     settings = Settings(imp)
 
     if detector == 'Log':
@@ -44,15 +68,9 @@ def run_trackmate_on_image(imp, detector='Log', spot_filters=[], display_spot=Tr
     elif detector == 'DoG':
         settings.detectorFactory = DogDetectorFactory()
     else:
-        sys.exit("Unsupported detector: " + detector)
-
-    settings.detectorSettings = {
-        'DO_SUBPIXEL_LOCALIZATION': True,
-        'RADIUS': 0.15,
-        'TARGET_CHANNEL': 1,
-        'THRESHOLD': 1.0,
-        'DO_MEDIAN_FILTERING': True,
-    }
+        raise TrackMateError("Unsupported detector: " + detector)
+
+    settings.detectorSettings = dict(DETECTOR_SETTINGS)
 
     for f in spot_filters:
         settings.addSpotFilter(FeatureFilter(f['feature'], f['value'], f['is_above']))
@@ -79,21 +97,133 @@ def run_trackmate_on_image(imp, detector='Log', spot_filters=[], display_spot=Tr
     tracker_settings['MERGING_FEATURE_PENALTIES'] = {}
     tracker_settings['SPLITTING_FEATURE_PENALTIES'] = {}
 
+    for key, value in (tracker_overrides or {}).items():
+        tracker_settings[key] = value
+
     settings.trackerSettings = tracker_settings
     settings.addAllAnalyzers()
+    return settings
+
+
+def detection_cache_path(imp, detector, cache_dir):
+    # Cache file for the detections of one image: keyed by the image file
+    # (path, size, mtime), its dimensions after the Z->T conversion and the
+    # detector with its settings, so any change invalidates the cache
+    info = imp.getOriginalFileInfo()
+    source = os.path.join(info.directory, info.fileName) if info is not None else imp.getTitle()
+    stat = os.stat(source) if os.path.exists(source) else None
+    key = repr((
+        os.path.abspath(source),
+        stat.st_size if stat else None,
+        int(stat.st_mtime) if stat else None,
+        tuple(imp.getDimensions()),
+        detector,
+        sorted(DETECTOR_SETTINGS.items()),
+    ))
+    digest = hashlib.sha1(key).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(cache_dir, '%s_detection_%s.xml' % (stem, digest))
+
+
+def detect_spots(imp, settings, cache_path=None, n_threads=None):
+    # Unfiltered detections with all spot features. With cache_path, they are
+    # read from the TrackMate XML written by an earlier run with the same key,
+    # or detected and written there. n_threads caps the detector's threads.
+    if cache_path is not None and os.path.exists(cache_path):
+        model = TmXmlReader(File(cache_path)).getModel()
+        model.setLogger(Logger.IJ_LOGGER)
+        model.getLogger().log("Loaded cached detections: " + cache_path)
+        return model
 
+    model = Model()
+    model.setLogger(Logger.IJ_LOGGER)
     trackmate = TrackMate(model, settings)
+    if n_threads is not None:
+        trackmate.setNumThreads(n_threads)
     if not trackmate.checkInput():
-        sys.exit(str(trackmate.getErrorMessage()))
-    if not trackmate.process():
-        sys.exit(str(trackmate.getErrorMessage()))
+        raise TrackMateError(str(trackmate.getErrorMessage()))
+    if not (trackmate.execDetection() and trackmate.execInitialSpotFiltering()
+            and trackmate.computeSpotFeatures(False)):
+        raise TrackMateError(str(trackmate.getErrorMessage()))
+
+    if cache_path is not None:
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        # Write next to the final name and rename, so concurrent runs never read a partial file
+        writer = TmXmlWriter(File(cache_path + '.tmp'))
+        writer.appendModel(model)
+        writer.appendSettings(settings)
+        writer.writeToFile()
+        File(cache_path + '.tmp').renameTo(File(cache_path))
+    return model
+
+
+def track_spots(model, settings, n_threads=None):
+    # Spot filtering, linking and track features on detected spots; the model
+    # can be tracked again with other settings (it keeps its detections)
+    trackmate = TrackMate(model, settings)
+    if n_threads is not None:
+        trackmate.setNumThreads(n_threads)
+    steps = (
+        lambda: trackmate.execSpotFiltering(False),
+        trackmate.execTracking,
+        lambda: trackmate.computeEdgeFeatures(False),
+        lambda: trackmate.computeTrackFeatures(False),
+        lambda: trackmate.execTrackFiltering(False),
+    )
+    for step in steps:
+        if not step():
+            raise TrackMateError(str(trackmate.getErrorMessage()))
+    return model
+
+
+def run_trackmate_on_image(imp, detector='Log', spot_filters=[], display_spot=True, display_track=True, display=True,
+                           n_threads=None, cache_dir=None, tracker_overrides=None):
+    # Raises TrackMateError instead of exiting, so a batch can go on with the next image.
+    # n_threads caps TrackMate's own threads (None: all cores).
+    # cache_dir keeps the detections per image and detector settings, so runs
+    # that only change filters or tracker settings skip detection.
+    settings = make_settings(imp, detector, spot_filters, tracker_overrides)
+
+    if cache_dir is None:
+        model = Model()
+        model.setLogger(Logger.IJ_LOGGER)
+        trackmate = TrackMate(model, settings)
+        if n_threads is not None:
+            trackmate.setNumThreads(n_threads)
+        if not trackmate.checkInput():
+            raise TrackMateError(str(trackmate.getErrorMessage()))
+        if not trackmate.process():
+            raise TrackMateError(str(trackmate.getErrorMessage()))
+    else:
+        model = detect_spots(imp, settings, detection_cache_path(imp, detector, cache_dir), n_threads)
+        track_spots(model, settings, n_threads)
 
     model.getLogger().log("Total spots after filtering: %d" % model.getSpots().getNSpots(True))
 
-    display_results(model, imp, display_spot, display_track)
+    # display=False (headless batches) never builds a displayer
+    if display:
+        display_results(model, imp, display_spot, display_track)
     return model
 
 
+def settings_grid(tracker_grid=None, filter_grid=None):
+    # Every combination of tracker settings and spot filter sets as a sweep:
+    # tracker_grid maps tracker keys to lists of values, filter_grid is a list
+    # of spot filter lists. Returns [{'name', 'tracker', 'spot_filters'}, ...].
+    tracker_grid = tracker_grid or {}
+    keys = sorted(tracker_grid)
+    sweep = []
+    for values in itertools.product(*[tracker_grid[key] for key in keys]):
+        for filters in (filter_grid or [[]]):
+            sweep.append({
+                'name': 'sweep%03d' % len(sweep),
+                'tracker': dict(zip(keys, values)),
+                'spot_filters': filters,
+            })
+    return sweep
+
+
 def display_results(model, imp, display_spot=True, display_track=True):
     from fiji.plugin.trackmate import SelectionModel
     sm = SelectionModel(model)
@@ -174,46 +304,280 @@ def export_spots_to_csv(model, output_csv_path):
             writer.writerow(row)
 
 
-def batch_process(input_folder, output_folder, detector='Log', spot_filters=[], display_spot=False, display_track=False):
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+# Columns of the binary spot export: (name, TrackMate feature, jarray type code).
+# 'd' columns are written as little-endian float64, 'i' as int32.
+SPOT_ARRAY_COLUMNS = [
+    ('TRACK_ID', None, 'i'),
+    ('SPOT_ID', None, 'i'),
+    ('FRAME', 'FRAME', 'i'),
+    ('POSITION_T', 'POSITION_T', 'd'),
+    ('POSITION_X', 'POSITION_X', 'd'),
+    ('POSITION_Y', 'POSITION_Y', 'd'),
+    ('POSITION_Z', 'POSITION_Z', 'd'),
+    ('RADIUS', 'RADIUS', 'd'),
+    ('QUALITY', 'QUALITY', 'd'),
+    ('MEAN_INTENSITY_CH1', 'MEAN_INTENSITY_CH1', 'd'),
+    ('MAX_INTENSITY_CH1', 'MAX_INTENSITY_CH1', 'd'),
+    ('MEDIAN_INTENSITY_CH1', 'MEDIAN_INTENSITY_CH1', 'd'),
+    ('SNR_CH1', 'SNR_CH1', 'd'),
+    ('CONTRAST_CH1', 'CONTRAST_CH1', 'd'),
+]
 
-    for filename in os.listdir(input_folder):
-        if filename.lower().endswith(".tif") or filename.lower().endswith(".tiff"):
-            filepath = os.path.join(input_folder, filename)
-            IJ.log("Processing: " + filepath)
-            imp = IJ.openImage(filepath)
-            if imp is None:
-                IJ.log("Failed to open: " + filepath)
-                continue
+NPY_DESCR = {'d': ('<f8', 8), 'i': ('<i4', 4)}
 
-            imp.show()
 
-            # --- Convert Z-stack to time series (do not convert if T > 1) ---
-            n_channels = imp.getNChannels()
-            n_slices = imp.getNSlices()  # Z
-            n_frames = imp.getNFrames()  # T
+def _write_npy(zip_stream, name, values, typecode):
+    # One column as a .npy member of the .npz (NumPy format version 1.0)
+    descr, item_size = NPY_DESCR[typecode]
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, len(values))
+    header += ' ' * ((64 - (10 + len(header) + 1) % 64) % 64) + '\n'
+    prefix = '\x93NUMPY\x01\x00' + chr(len(header) & 0xff) + chr(len(header) >> 8) + header
 
-            if n_slices > 1 and n_frames == 1:
-                IJ.log("Z>1 and T=1 detected. Converting Z-stack to time series...")
-                imp.setDimensions(n_channels, 1, n_slices)
+    data = ByteBuffer.allocate(len(values) * item_size).order(ByteOrder.LITTLE_ENDIAN)
+    if typecode == 'd':
+        data.asDoubleBuffer().put(values)
+    else:
+        data.asIntBuffer().put(values)
+
+    zip_stream.putNextEntry(ZipEntry(name + '.npy'))
+    zip_stream.write(String(prefix).getBytes('ISO-8859-1'))
+    zip_stream.write(data.array())
+    zip_stream.closeEntry()
 
 
+def export_spots_to_npz(model, imp, output_npz_path):
+    # Tracked spots as full-precision columns in a .npz, sorted by track and
+    # frame, plus a .json sidecar with the time interval and calibration.
+    # msd_calculation.make_msd_csv reads it directly (no text parsing, no sort).
+    tracks = model.getTrackModel()
+    track_ids = sorted(tracks.trackIDs(True))
+
+    # Size the primitive arrays first, then fill them in one pass over the spots
+    n_spots = 0
+    for track_id in track_ids:
+        n_spots += tracks.trackSpots(track_id).size()
+    columns = [jarray.zeros(n_spots, typecode) for _, _, typecode in SPOT_ARRAY_COLUMNS]
+    nan = float('nan')
+
+    row = 0
+    for track_id in track_ids:
+        spots = sorted(tracks.trackSpots(track_id), key=lambda spot: spot.getFeature('FRAME'))
+        for spot in spots:
+            columns[0][row] = track_id
+            columns[1][row] = spot.ID()
+            for i in range(2, len(SPOT_ARRAY_COLUMNS)):
+                value = spot.getFeature(SPOT_ARRAY_COLUMNS[i][1])
+                if SPOT_ARRAY_COLUMNS[i][2] == 'i':
+                    columns[i][row] = -1 if value is None else int(round(value))
+                else:
+                    columns[i][row] = nan if value is None else value
+            row += 1
+
+    zip_stream = ZipOutputStream(BufferedOutputStream(FileOutputStream(output_npz_path)))
+    zip_stream.setLevel(1)
+    try:
+        for (name, _, typecode), values in zip(SPOT_ARRAY_COLUMNS, columns):
+            _write_npy(zip_stream, name, values, typecode)
+    finally:
+        zip_stream.close()
+
+    # TrackMate falls back to 1 when the image has no frame interval, and POSITION_T follows it
+    cal = imp.getCalibration()
+    metadata = {
+        'time_interval': cal.frameInterval if cal.frameInterval > 0 else 1.0,
+        'time_unit': cal.getTimeUnit(),
+        'pixel_width': cal.pixelWidth,
+        'pixel_height': cal.pixelHeight,
+        'voxel_depth': cal.pixelDepth,
+        'space_unit': cal.getUnit(),
+        'source_image': imp.getTitle(),
+        'n_spots': n_spots,
+        'n_tracks': len(track_ids),
+        'columns': [name for name, _, _ in SPOT_ARRAY_COLUMNS],
+        'sorted_by': ['TRACK_ID', 'FRAME'],
+    }
+    with codecs.open(os.path.splitext(output_npz_path)[0] + '.json', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+
+
+def heap_used_mb():
+    runtime = Runtime.getRuntime()
+    return (runtime.totalMemory() - runtime.freeMemory()) / (1024.0 * 1024.0)
+
+
+def heap_max_mb():
+    return Runtime.getRuntime().maxMemory() / (1024.0 * 1024.0)
+
+
+def release_image(imp, model=None):
+    # Drop the image data and the TrackMate model so nothing from a finished
+    # file stays on the heap during long batches
+    if model is not None:
+        model.clearTracks(False)
+        model.clearSpots(False)
+    imp.changes = False
+    imp.close()
+    imp.flush()
+
+
+def export_model(model, imp, output_folder, stem, export_format):
+    if export_format in ('csv', 'both'):
+        csv_name = stem + '_allspots.csv'
+        csv_path = os.path.join(output_folder, csv_name)
+        export_spots_to_csv(model, csv_path)
+    if export_format in ('npz', 'both'):
+        npz_name = stem + '_spots.npz'
+        export_spots_to_npz(model, imp, os.path.join(output_folder, npz_name))
+
+
+def sweep_image(imp, output_folder, stem, sweep, detector='Log', export_format='csv', n_threads=None,
+                cache_dir=None):
+    # Detect once (or load the cached detections), then filter, track and
+    # export for every entry of the sweep as <stem>_<name>_allspots.csv etc.
+    # <stem>_sweep.csv lists the settings behind each name.
+    cache_path = detection_cache_path(imp, detector, cache_dir) if cache_dir is not None else None
+    model = detect_spots(imp, make_settings(imp, detector), cache_path, n_threads)
+
+    with codecs.open(os.path.join(output_folder, stem + '_sweep.csv'), 'w', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'tracker_settings', 'spot_filters'])
+        for entry in sweep:
+            settings = make_settings(imp, detector, entry['spot_filters'], entry['tracker'])
+            track_spots(model, settings, n_threads)
+            export_model(model, imp, output_folder, stem + '_' + entry['name'], export_format)
+            writer.writerow([entry['name'], json.dumps(entry['tracker'], sort_keys=True),
+                             json.dumps(entry['spot_filters'], sort_keys=True)])
+    return model
+
+
+def process_image(filepath, output_folder, detector='Log', spot_filters=[], display_spot=False, display_track=False,
+                  export_format='csv', headless=False, virtual_stack=False, n_threads=None, cache_dir=None,
+                  sweep=None):
+    # Detection, tracking and export for one TIFF. Output names depend only on
+    # the input name, so results are the same whatever order images finish in.
+    # sweep (see settings_grid) replaces the single run by a settings sweep.
+    filename = os.path.basename(filepath)
+    IJ.log("Processing: " + filepath)
+    start = time.time()
+    imp = IJ.openVirtual(filepath) if virtual_stack else IJ.openImage(filepath)
+    if imp is None:
+        raise TrackMateError("Failed to open: " + filepath)
+
+    if not headless:
+        imp.show()
+
+    model = None
+    try:
+        # --- Convert Z-stack to time series (do not convert if T > 1) ---
+        n_channels = imp.getNChannels()
+        n_slices = imp.getNSlices()  # Z
+        n_frames = imp.getNFrames()  # T
+
+        if n_slices > 1 and n_frames == 1:
+            IJ.log("Z>1 and T=1 detected. Converting Z-stack to time series...")
+            imp.setDimensions(n_channels, 1, n_slices)
+
+
+        stem = os.path.splitext(filename)[0]
+        if sweep:
+            model = sweep_image(imp, output_folder, stem, sweep, detector, export_format, n_threads, cache_dir)
+        else:
             model = run_trackmate_on_image(
                 imp,
                 detector=detector,
                 spot_filters=spot_filters,
                 display_spot=display_spot,
-                display_track=display_track
+                display_track=display_track,
+                display=not headless,
+                n_threads=n_threads,
+                cache_dir=cache_dir
             )
-
-            csv_name = os.path.splitext(filename)[0] + '_allspots.csv'
-            csv_path = os.path.join(output_folder, csv_name)
-            export_spots_to_csv(model, csv_path)
-
+            export_model(model, imp, output_folder, stem, export_format)
+    finally:
+        if headless:
+            release_image(imp, model)
+            model = None
+        else:
             imp.changes = False
             # imp.close()
 
+    IJ.log("Finished %s in %.1f s (heap %.0f / %.0f MB)"
+           % (filename, time.time() - start, heap_used_mb(), heap_max_mb()))
+
+
+class _ImageJob(Callable):
+    # One process_image call for the JVM thread pool; returns None or the error message
+    def __init__(self, filepath, kwargs):
+        self.filepath = filepath
+        self.kwargs = kwargs
+
+    def call(self):
+        try:
+            process_image(self.filepath, **self.kwargs)
+            return None
+        except (Exception, JavaException) as e:
+            return str(e)
+
+
+def batch_process(input_folder, output_folder, detector='Log', spot_filters=[], display_spot=False, display_track=False,
+                  export_format='csv', headless=False, virtual_stack=False, max_images=1, cache_dir=None,
+                  sweep=None):
+    # export_format: 'csv' (<name>_allspots.csv), 'npz' (<name>_spots.npz for
+    # msd_calculation) or 'both'
+    # headless=True never shows the image or builds a displayer, and releases
+    # every image and model once its exports are written; virtual_stack=True
+    # opens TIFFs as virtual stacks (planes are read on demand)
+    # max_images > 1 runs that many images at once on a JVM thread pool (always
+    # headless), each TrackMate instance getting cores / max_images threads.
+    # A failing image is logged and the batch goes on; returns {path: error}.
+    # cache_dir keeps each image's detections (TrackMate XML) for later runs;
+    # sweep runs a list of filter/tracker settings (see settings_grid) on one
+    # detection per image.
+    if export_format not in ('csv', 'npz', 'both'):
+        sys.exit("Unsupported export format: " + export_format)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    filepaths = [os.path.join(input_folder, filename) for filename in sorted(os.listdir(input_folder))
+                 if filename.lower().endswith(".tif") or filename.lower().endswith(".tiff")]
+    kwargs = {
+        'detector': detector,
+        'spot_filters': spot_filters,
+        'display_spot': display_spot,
+        'display_track': display_track,
+        'export_format': export_format,
+        'headless': headless or max_images > 1,
+        'virtual_stack': virtual_stack,
+        'output_folder': output_folder,
+        'cache_dir': cache_dir,
+        'sweep': sweep,
+    }
+
+    errors = {}
+    if max_images <= 1:
+        for filepath in filepaths:
+            error = _ImageJob(filepath, kwargs).call()
+            if error is not None:
+                errors[filepath] = error
+                IJ.log("Failed: %s (%s)" % (filepath, error))
+    else:
+        kwargs['n_threads'] = max(1, Runtime.getRuntime().availableProcessors() // max_images)
+        pool = Executors.newFixedThreadPool(max_images)
+        try:
+            # Submitted and collected in file order, so the log summary is deterministic
+            futures = [(filepath, pool.submit(_ImageJob(filepath, kwargs))) for filepath in filepaths]
+            for filepath, future in futures:
+                error = future.get()
+                if error is not None:
+                    errors[filepath] = error
+                    IJ.log("Failed: %s (%s)" % (filepath, error))
+        finally:
+            pool.shutdown()
+
+    IJ.log("Batch finished: %d of %d images processed (%d failed)"
+           % (len(filepaths) - len(errors), len(filepaths), len(errors)))
+    return errors
+
 
 ########## Run settings ##########
 
@@ -231,5 +595,12 @@ batch_process(
     detector='Log',
     spot_filters=filters,
     display_spot=True,
-    display_track=False
+    display_track=False,
+    export_format='csv',
+    headless=False,
+    virtual_stack=False,
+    max_images=1,
+    cache_dir=None,
+    # e.g. settings_grid({'LINKING_MAX_DISTANCE': [0.1, 0.2], 'MAX_FRAME_GAP': [1, 3]}, [filters])
+    sweep=None
 )
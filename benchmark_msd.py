@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark for the MSD pipeline in msd_calculation.py
+# ----------------------------------------------------
+# Generates synthetic TrackMate track exports (free, confined or anomalous
+# diffusion), times make_msd_csv, merge_msd_csvs, plot_msd and plot_merged_msd
+# at several scales, checks the MSD against the analytic 4*D*t^alpha and
+# writes everything to a JSON file so runs can be compared.
+#
+# Example:
+# python benchmark_msd.py --scales 100 1000 10000 --mode anomalous --alpha 0.6 --output bench.json
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+import pandas as pd
+
+import msd_calculation
+
+DIFFUSION_MODES = ("free", "confined", "anomalous")
+LENGTH_DISTRIBUTIONS = ("fixed", "uniform", "geometric")
+
+def _track_lengths(rng, n_tracks, distribution, mean_length, min_length=2):
+    # Number of frames of every track
+    if distribution == "fixed":
+        lengths = np.full(n_tracks, mean_length)
+    elif distribution == "uniform":
+        lengths = rng.integers(min_length, 2 * mean_length - min_length + 1, size=n_tracks)
+    elif distribution == "geometric":
+        lengths = min_length + rng.geometric(1.0 / max(mean_length - min_length + 1, 1), size=n_tracks) - 1
+    else:
+        raise ValueError(f"Unknown length distribution: {distribution} (choose from {', '.join(LENGTH_DISTRIBUTIONS)})")
+    return np.maximum(lengths, min_length).astype(int)
+
+def _fractional_gaussian_noise(rng, n_tracks, n_steps, hurst):
+    # Unit-variance fractional Gaussian noise for n_tracks x n_steps x 2 axes
+    # by circulant embedding (Davies-Harte), vectorized over tracks and axes
+    k = np.arange(n_steps + 1)
+    gamma = 0.5 * (np.abs(k + 1) ** (2 * hurst) - 2 * np.abs(k) ** (2 * hurst) + np.abs(k - 1) ** (2 * hurst))
+    row = np.concatenate((gamma, gamma[-2:0:-1]))
+    eigenvalues = np.maximum(np.fft.fft(row).real, 0.0)
+    m = len(row)
+    noise = rng.standard_normal((n_tracks, 2, m)) + 1j * rng.standard_normal((n_tracks, 2, m))
+    fgn = np.fft.fft(np.sqrt(eigenvalues / m) * noise, axis=2).real[:, :, :n_steps]
+    return fgn.transpose(0, 2, 1)
+
+def simulate_tracks(n_tracks, time_interval=0.2, diffusion=0.05, mode="free", alpha=1.0,
+                    confinement=0.5, length_distribution="geometric", mean_length=50, seed=0):
+    # Synthetic 2D trajectories with MSD = 4 * D * t^alpha (free: alpha = 1).
+    # "confined" runs free diffusion inside a square box of side `confinement`
+    # with reflecting walls. Returns a TRACK_ID/POSITION_T/POSITION_X/POSITION_Y table.
+    if mode not in DIFFUSION_MODES:
+        raise ValueError(f"Unknown diffusion mode: {mode} (choose from {', '.join(DIFFUSION_MODES)})")
+    rng = np.random.default_rng(seed)
+    lengths = _track_lengths(rng, n_tracks, length_distribution, mean_length)
+    tracks = []
+
+    # Simulate tracks of equal length together
+    for length in np.unique(lengths):
+        ids = np.flatnonzero(lengths == length)
+        n_steps = length - 1
+        if mode == "anomalous":
+            # Per-axis variance over a lag of k frames: 2 * D * (k * dt)^alpha
+            scale = np.sqrt(2 * diffusion * time_interval ** alpha)
+            steps = scale * _fractional_gaussian_noise(rng, len(ids), n_steps, alpha / 2)
+        else:
+            steps = rng.normal(0.0, np.sqrt(2 * diffusion * time_interval), size=(len(ids), n_steps, 2))
+
+        start = rng.uniform(0, 50, size=(len(ids), 1, 2))
+        if mode == "confined":
+            # Fold the free walk back into [0, confinement) (reflecting walls)
+            walk = np.cumsum(np.concatenate((np.zeros((len(ids), 1, 2)), steps), axis=1), axis=1)
+            walk = np.abs((walk + confinement / 2) % (2 * confinement) - confinement)
+            positions = start + walk
+        else:
+            positions = start + np.cumsum(np.concatenate((np.zeros((len(ids), 1, 2)), steps), axis=1), axis=1)
+
+        tracks.append(pd.DataFrame({
+            "TRACK_ID": np.repeat(ids, length),
+            "POSITION_T": np.tile(np.arange(length) * time_interval, len(ids)),
+            "POSITION_X": positions[:, :, 0].ravel(),
+            "POSITION_Y": positions[:, :, 1].ravel(),
+        }))
+
+    return pd.concat(tracks, ignore_index=True).sort_values(["TRACK_ID", "POSITION_T"], ignore_index=True)
+
+def write_trackmate_csv(df, path, time_interval, shuffle=False, seed=0):
+    # TrackMate layout: column header plus the four extra header rows that
+    # make_msd_csv skips with skiprows=[1, 2, 3, 4]
+    df = df.copy()
+    df.insert(0, "LABEL", "ID" + df.index.astype(str))
+    df.insert(1, "ID", df.index)
+    df["FRAME"] = np.round(df["POSITION_T"] / time_interval).astype(int)
+    if shuffle:
+        df = df.sample(frac=1.0, random_state=seed)
+    columns = list(df.columns)
+    with open(path, "w") as f:
+        f.write(",".join(columns) + "\n")
+        f.write(",".join(c.replace("_", " ").title() for c in columns) + "\n")
+        f.write(",".join(c.replace("_", " ").title() for c in columns) + "\n")
+        f.write(",".join("(sec)" if c == "POSITION_T" else "(micron)" if c.startswith("POSITION") else ""
+                         for c in columns) + "\n")
+        f.write(",".join("" for c in columns) + "\n")
+    df.to_csv(path, mode="a", header=False, index=False)
+
+def check_msd(msd_table, time_interval, diffusion, alpha, max_check_lag=10, track_lengths=None):
+    # Track-averaged MSD (weighted by pairs per lag) against 4 * D * t^alpha.
+    # The pairs come from n_pairs when the table has it, else from the track
+    # lengths (track_lengths: frames per TRACK_ID, as the table may be cut at max_lag)
+    df = msd_table[msd_table["interval"] > 0].copy()
+    lag = np.round(df["interval"] / time_interval).astype(int)
+    df, lag = df[lag <= max_check_lag], lag[lag <= max_check_lag]
+    if "n_pairs" in df:
+        weights = df["n_pairs"].astype(float)
+    else:
+        if track_lengths is None:
+            track_lengths = msd_table.groupby("TRACK_ID").size()
+        weights = (df["TRACK_ID"].map(track_lengths) - lag).clip(lower=1)
+    measured = (df["msd"] * weights).groupby(df["interval"]).sum() / weights.groupby(df["interval"]).sum()
+    expected = 4 * diffusion * measured.index.values ** alpha
+    relative_error = np.abs(measured.values - expected) / expected
+    return {
+        "lags": [float(t) for t in measured.index],
+        "measured": [float(v) for v in measured.values],
+        "expected": [float(v) for v in expected],
+        "max_relative_error": float(relative_error.max()) if len(relative_error) else None,
+    }
+
+def _timed(results, scale, stage, function, *args, **kwargs):
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    results.append({"tracks": scale, "stage": stage, "seconds": seconds})
+    print(f"{scale:>8} tracks  {stage:<28} {seconds:9.3f} s")
+    return value
+
+def run_benchmark(scales, methods=("frames",), mode="free", diffusion=0.05, alpha=1.0, time_interval=0.2,
+                  length_distribution="geometric", mean_length=50, files_per_scale=2, max_lag=30,
+                  plot_max_tracks=1000, tolerance=0.1, seed=0, work_dir=None):
+    results = []
+    correctness = []
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        for scale in scales:
+            condition = os.path.join(tmp, f"tracks_{scale}")
+            os.makedirs(condition)
+
+            # Split the tracks of this scale over several input files
+            input_files = []
+            for n in range(files_per_scale):
+                df = simulate_tracks(max(scale // files_per_scale, 1), time_interval, diffusion, mode, alpha,
+                                     length_distribution=length_distribution, mean_length=mean_length,
+                                     seed=seed + n)
+                if n == 0:
+                    track_lengths = df.groupby("TRACK_ID").size()
+                path = os.path.join(condition, f"synthetic_{n}.csv")
+                write_trackmate_csv(df, path, time_interval, shuffle=True, seed=seed + n)
+                input_files.append(path)
+
+            # Every method gets its own output folders, so their tables never overwrite each other
+            for method in methods:
+                method_dir = os.path.join(condition, method)
+                msd_folder = os.path.join(method_dir, "msd_csv")
+                msd_files = []
+                for path in input_files:
+                    msd_files.append(_timed(results, scale, f"make_msd_csv[{method}]", msd_calculation.make_msd_csv,
+                                            path, time_interval, msd_folder, method=method, max_lag=max_lag))
+
+                msd_table = msd_calculation.read_msd_table(msd_files[0])
+                if mode != "confined":
+                    check = check_msd(msd_table, time_interval, diffusion, alpha, track_lengths=track_lengths)
+                    passed = check["max_relative_error"] <= tolerance
+                    check.update({"tracks": scale, "method": method, "passed": passed})
+                    correctness.append(check)
+                    print(f"{scale:>8} tracks  [{method}] MSD vs 4Dt^alpha: max relative error "
+                          f"{check['max_relative_error']:.3f} ({'ok' if check['passed'] else 'FAILED'})")
+
+                merge_folder = os.path.join(method_dir, "msd_merge")
+                os.makedirs(merge_folder)
+                merged = os.path.join(merge_folder, "merged_msd_data.csv")
+                _timed(results, scale, f"merge_msd_csvs[{method}]", msd_calculation.merge_msd_csvs, msd_folder, merged)
+
+                if scale <= plot_max_tracks:
+                    _timed(results, scale, f"plot_msd[{method}]", msd_calculation.plot_msd, msd_files[0],
+                           os.path.join(method_dir, "msd_plots"), progress=False)
+                else:
+                    results.append({"tracks": scale, "stage": f"plot_msd[{method}]", "seconds": None, "skipped": True})
+                _timed(results, scale, f"plot_merged_msd[{method}]", msd_calculation.plot_merged_msd, merged,
+                       os.path.join(merge_folder, "all_tracks_msd_first_30_intervals.png"), (0, 6), (0, 0.5))
+
+    return results, correctness
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the MSD pipeline on synthetic TrackMate exports.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100, 1000, 10000], help="Track counts to time")
+    parser.add_argument("--methods", nargs="+", choices=msd_calculation.MSD_METHODS, default=["frames"])
+    parser.add_argument("--mode", choices=DIFFUSION_MODES, default="free", help="Diffusion model")
+    parser.add_argument("--diffusion", type=float, default=0.05, help="Diffusion coefficient D")
+    parser.add_argument("--alpha", type=float, default=1.0, help="Anomalous exponent (mode=anomalous)")
+    parser.add_argument("--time-interval", type=float, default=0.2)
+    parser.add_argument("--length-distribution", choices=LENGTH_DISTRIBUTIONS, default="geometric")
+    parser.add_argument("--mean-length", type=int, default=50, help="Mean frames per track")
+    parser.add_argument("--files-per-scale", type=int, default=2)
+    parser.add_argument("--max-lag", type=int, default=30)
+    parser.add_argument("--plot-max-tracks", type=int, default=1000,
+                        help="Skip plot_msd (one PNG per track) above this many tracks")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative MSD error")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="Where to write the temporary data")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    if args.mode != "anomalous":
+        args.alpha = 1.0
+
+    results, correctness = run_benchmark(
+        args.scales, args.methods, args.mode, args.diffusion, args.alpha, args.time_interval,
+        args.length_distribution, args.mean_length, args.files_per_scale, args.max_lag,
+        args.plot_max_tracks, args.tolerance, args.seed, args.work_dir)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "config": vars(args),
+        "timings": results,
+        "correctness": correctness,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved as {args.output}")
+
+    return 0 if all(check["passed"] for check in correctness) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
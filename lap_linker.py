@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# Frame-to-frame LAP linker for exported spot tables
+# --------------------------------------------------
+# Re-links the spots of the *_allspots.csv files written by
+# Trackmate.py (export_spots_to_csv) without going back to Fiji, following
+# TrackMate's SparseLAPTracker (Jaqaman et al. 2008) as configured there:
+#
+# 1. Frame-to-frame linking: candidates within the linking max distance
+#    (KD-tree), cost = squared distance, one LAP per pair of consecutive
+#    frames with "no link" costs of ALTERNATIVE_LINKING_COST_FACTOR times the
+#    CUTOFF_PERCENTILE of that frame pair's costs.
+# 2. Optional gap closing: segment ends joined to segment starts up to
+#    MAX_FRAME_GAP frames later within the gap-closing max distance, solved
+#    as one LAP with the same alternative-cost rule.
+#
+# Splitting and merging are not implemented (they are off in Trackmate.py).
+# The output is a TRACK_ID table (TrackMate CSV layout or .npz spot arrays)
+# that msd_calculation.make_msd_csv reads directly. Requires scipy.
+#
+# Example:
+# python lap_linker.py spots/*_allspots.csv --time-interval 0.2 --output-dir linked --gap-closing
+
+import os
+import sys
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+import msd_calculation
+
+# Tracker settings of Trackmate.py (run_trackmate_on_image)
+LINKING_MAX_DISTANCE = 0.1
+GAP_CLOSING_MAX_DISTANCE = 0.4
+MAX_FRAME_GAP = 3
+ALTERNATIVE_LINKING_COST_FACTOR = 1.05
+CUTOFF_PERCENTILE = 0.9
+
+OUTPUT_FORMATS = ("csv", "npz")
+
+def read_spot_table(path):
+    # Spot ID, frame and position of every spot in an export_spots_to_csv
+    # file (or a Trackmate.py .npz export); spots without a frame are dropped
+    if path.endswith(msd_calculation.SPOT_ARRAY_EXTENSION):
+        with np.load(path) as data:
+            spots = pd.DataFrame({"SPOT_ID": data["SPOT_ID"], "FRAME": data["FRAME"],
+                                  "POSITION_X": data["POSITION_X"], "POSITION_Y": data["POSITION_Y"]})
+        spots = spots[spots["FRAME"] >= 0]
+    else:
+        spots = pd.read_csv(path, usecols=["Spot_ID", "Frame", "Position_X", "Position_Y"],
+                            dtype={"Spot_ID": "int64", "Frame": "float64",
+                                   "Position_X": "float64", "Position_Y": "float64"})
+        spots.columns = ["SPOT_ID", "FRAME", "POSITION_X", "POSITION_Y"]
+        spots = spots.dropna(subset=["FRAME"])
+    spots = spots.astype({"FRAME": np.int64})
+    return spots.sort_values(["FRAME", "SPOT_ID"], ignore_index=True)
+
+def _frame_pairs(xy, frames, sources, targets, frame_gap, max_distance):
+    # Candidate (source, target) pairs whose frames are exactly frame_gap apart
+    # and that lie within max_distance. Frames are a third KD-tree coordinate
+    # spaced further apart than the cutoff, so one sparse distance query finds
+    # the pairs of all frames at once. Returns sources, targets and squared distances.
+    spacing = 2.0 * max_distance + 1.0
+    source_tree = cKDTree(np.column_stack((xy[sources], frames[sources] * spacing)))
+    target_tree = cKDTree(np.column_stack((xy[targets], (frames[targets] - frame_gap) * spacing)))
+    pairs = source_tree.sparse_distance_matrix(target_tree, max_distance, output_type="coo_matrix")
+    return sources[pairs.row], targets[pairs.col], pairs.data ** 2
+
+def _alternative_costs(costs, groups, n_groups, factor, percentile):
+    # Per-group "no link" cost (factor x cost percentile) and lowest cost
+    alternative = np.ones(n_groups)
+    lowest = np.ones(n_groups)
+    if len(costs):
+        by_group = pd.Series(costs).groupby(groups)
+        alternative[by_group.size().index] = factor * by_group.quantile(percentile).values
+        lowest[by_group.size().index] = by_group.min().values
+    return alternative, lowest
+
+def _solve_lap(rows, cols, costs, n_rows, n_cols, row_alternative, col_alternative, edge_lowest):
+    # Jaqaman's augmented LAP: [[C, row alternatives], [column alternatives, C^T]]
+    # where the lower-right block holds the lowest cost of each candidate's
+    # group. Every (row, column) is free to stay unlinked, so a full matching
+    # always exists. Returns the linked (row, col) pairs.
+    if len(costs) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    row_ids = np.arange(n_rows)
+    col_ids = np.arange(n_cols)
+    i = np.concatenate((rows, row_ids, n_rows + col_ids, n_rows + cols))
+    j = np.concatenate((cols, n_cols + row_ids, col_ids, n_cols + rows))
+    # Every full matching has n_rows + n_cols edges, so a constant offset keeps
+    # the optimum and stops zero costs from being read as missing edges
+    w = np.concatenate((costs, row_alternative, col_alternative, edge_lowest)) + 1.0
+    matrix = csr_matrix((w, (i, j)), shape=(n_rows + n_cols, n_rows + n_cols))
+    matched_rows, matched_cols = min_weight_full_bipartite_matching(matrix)
+    linked = (matched_rows < n_rows) & (matched_cols < n_cols)
+    return matched_rows[linked], matched_cols[linked]
+
+def _chain_roots(predecessor):
+    # First element of every chain given each element's predecessor (-1 at
+    # chain starts), by pointer jumping: O(n log length), no Python loop per element
+    root = np.where(predecessor >= 0, predecessor, np.arange(len(predecessor)))
+    while True:
+        jumped = root[root]
+        if np.array_equal(jumped, root):
+            return root
+        root = jumped
+
+def link_spots(spots, linking_max_distance=LINKING_MAX_DISTANCE, gap_closing=False,
+               gap_closing_max_distance=GAP_CLOSING_MAX_DISTANCE, max_frame_gap=MAX_FRAME_GAP,
+               alternative_cost_factor=ALTERNATIVE_LINKING_COST_FACTOR, cutoff_percentile=CUTOFF_PERCENTILE):
+    # TRACK_ID for every spot of a FRAME-sorted spot table (-1 for spots left
+    # on their own, which TrackMate does not report as tracks)
+    xy = spots[["POSITION_X", "POSITION_Y"]].values.astype(float)
+    frames = spots["FRAME"].values
+    n = len(spots)
+    all_spots = np.arange(n)
+
+    # 1. Frame-to-frame LAP, one independent block per frame pair solved in one call
+    sources, targets, costs = _frame_pairs(xy, frames, all_spots, all_spots, 1, linking_max_distance)
+    block = frames - (frames.min() if n else 0)
+    alternative, lowest = _alternative_costs(costs, block[sources], block.max(initial=0) + 1,
+                                             alternative_cost_factor, cutoff_percentile)
+    linked_sources, linked_targets = _solve_lap(
+        sources, targets, costs, n, n, alternative[block], alternative[np.maximum(block - 1, 0)],
+        lowest[block[sources]])
+    predecessor = np.full(n, -1)
+    predecessor[linked_targets] = linked_sources
+    segment = _chain_roots(predecessor)
+
+    # 2. Gap closing between segment ends and later segment starts
+    if gap_closing:
+        successor = np.full(n, -1)
+        successor[linked_sources] = linked_targets
+        starts = np.flatnonzero(predecessor < 0)
+        ends = np.flatnonzero(successor < 0)
+        # Frame differences 1..max_frame_gap, as TrackMate's segment cost matrix
+        candidates = [_frame_pairs(xy, frames, ends, starts, gap, gap_closing_max_distance)
+                      for gap in range(1, max_frame_gap + 1)]
+        sources = np.concatenate([c[0] for c in candidates])
+        targets = np.concatenate([c[1] for c in candidates])
+        costs = np.concatenate([c[2] for c in candidates])
+
+        if len(costs):
+            end_index = np.full(n, -1)
+            end_index[ends] = np.arange(len(ends))
+            start_index = np.full(n, -1)
+            start_index[starts] = np.arange(len(starts))
+            alternative, lowest = _alternative_costs(costs, np.zeros(len(costs), dtype=int), 1,
+                                                     alternative_cost_factor, cutoff_percentile)
+            rows, cols = _solve_lap(end_index[sources], start_index[targets], costs, len(ends), len(starts),
+                                    np.full(len(ends), alternative[0]), np.full(len(starts), alternative[0]),
+                                    np.full(len(costs), lowest[0]))
+            # Chain the segments: each segment start points to the end it was joined to
+            segment_predecessor = np.full(n, -1)
+            segment_predecessor[starts[cols]] = segment[ends[rows]]
+            segment_root = _chain_roots(np.where(predecessor < 0, segment_predecessor, -1))
+            segment = segment_root[segment]
+
+    # Number the tracks (2+ spots) in order of their first spot
+    roots, first, sizes = np.unique(segment, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    track_of_root = np.full(n, -1)
+    numbered = order[sizes[order] > 1]
+    track_of_root[roots[numbered]] = np.arange(len(numbered))
+    return track_of_root[segment]
+
+def write_tracks(spots, output_file, time_interval):
+    # Tracked spots sorted by TRACK_ID and frame, as a TrackMate-style CSV
+    # (with the four extra header rows make_msd_csv skips) or .npz spot arrays
+    tracks = spots[spots["TRACK_ID"] >= 0].copy()
+    tracks["POSITION_T"] = tracks["FRAME"] * time_interval
+    tracks = tracks.sort_values(["TRACK_ID", "FRAME"], ignore_index=True)
+    tracks = tracks[["TRACK_ID", "SPOT_ID", "FRAME", "POSITION_T", "POSITION_X", "POSITION_Y"]]
+
+    if output_file.endswith(msd_calculation.SPOT_ARRAY_EXTENSION):
+        np.savez(output_file, **{col: tracks[col].values for col in tracks.columns})
+        msd_calculation.write_msd_metadata(output_file, {
+            "time_interval": time_interval,
+            "n_spots": len(tracks),
+            "n_tracks": int(tracks["TRACK_ID"].nunique()),
+            "columns": list(tracks.columns),
+            "sorted_by": ["TRACK_ID", "FRAME"],
+        })
+        return
+
+    columns = list(tracks.columns)
+    with open(output_file, "w") as f:
+        f.write(",".join(columns) + "\n")
+        f.write(",".join(c.replace("_", " ").title() for c in columns) + "\n")
+        f.write(",".join(c.replace("_", " ").title() for c in columns) + "\n")
+        f.write(",".join("(sec)" if c == "POSITION_T" else "(micron)" if c.startswith("POSITION") else ""
+                         for c in columns) + "\n")
+        f.write(",".join("" for c in columns) + "\n")
+    tracks.to_csv(output_file, mode="a", header=False, index=False)
+
+def link_file(input_file, output_dir, time_interval, output_format="csv", linking_max_distances=(LINKING_MAX_DISTANCE,),
+              max_frame_gaps=(MAX_FRAME_GAP,), gap_closing=False, gap_closing_max_distance=GAP_CLOSING_MAX_DISTANCE,
+              alternative_cost_factor=ALTERNATIVE_LINKING_COST_FACTOR, cutoff_percentile=CUTOFF_PERCENTILE):
+    # Link one spot table for every combination of linking distance and max
+    # frame gap (a sweep reads the spots once); outputs are named
+    # <stem>_tracks.<ext>, or <stem>_link<d>_gap<g>_tracks.<ext> when sweeping
+    spots = read_spot_table(input_file)
+    stem = os.path.splitext(os.path.basename(input_file))[0].replace("_allspots", "").replace("_spots", "")
+    combinations = list(itertools.product(linking_max_distances, max_frame_gaps if gap_closing else [None]))
+    outputs = []
+    for linking_max_distance, max_frame_gap in combinations:
+        spots["TRACK_ID"] = link_spots(spots, linking_max_distance, gap_closing, gap_closing_max_distance,
+                                       max_frame_gap or 0, alternative_cost_factor, cutoff_percentile)
+        suffix = ""
+        if len(combinations) > 1:
+            suffix = f"_link{linking_max_distance:g}" + (f"_gap{max_frame_gap}" if gap_closing else "")
+        output_file = os.path.join(output_dir, f"{stem}{suffix}_tracks.{output_format}")
+        write_tracks(spots, output_file, time_interval)
+        n_tracks = int(spots["TRACK_ID"].values.max(initial=-1)) + 1
+        print(f"{os.path.basename(input_file)}: {n_tracks} tracks from {len(spots)} spots -> {output_file}")
+        outputs.append(output_file)
+    return outputs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Link exported TrackMate spots into tracks (LAP tracker).")
+    parser.add_argument("inputs", nargs="+", help="*_allspots.csv files from Trackmate.py (or .npz spot exports)")
+    parser.add_argument("--time-interval", type=float, default=0.2, help="Frame interval in seconds")
+    parser.add_argument("--output-dir", default=None, help="Output folder (default: next to each input)")
+    parser.add_argument("--format", dest="output_format", choices=OUTPUT_FORMATS, default="csv")
+    parser.add_argument("--linking-max-distance", type=float, nargs="+", default=[LINKING_MAX_DISTANCE],
+                        help="One or more values (several values sweep)")
+    parser.add_argument("--gap-closing", action="store_true", help="Allow gap closing (off in Trackmate.py)")
+    parser.add_argument("--gap-closing-max-distance", type=float, default=GAP_CLOSING_MAX_DISTANCE)
+    parser.add_argument("--max-frame-gap", type=int, nargs="+", default=[MAX_FRAME_GAP],
+                        help="One or more values (several values sweep)")
+    parser.add_argument("--alternative-cost-factor", type=float, default=ALTERNATIVE_LINKING_COST_FACTOR)
+    parser.add_argument("--cutoff-percentile", type=float, default=CUTOFF_PERCENTILE)
+    args = parser.parse_args(argv)
+
+    errors = {}
+    for input_file in args.inputs:
+        output_dir = args.output_dir or os.path.dirname(os.path.abspath(input_file))
+        os.makedirs(output_dir, exist_ok=True)
+        try:
+            link_file(input_file, output_dir, args.time_interval, args.output_format, args.linking_max_distance,
+                      args.max_frame_gap, args.gap_closing, args.gap_closing_max_distance,
+                      args.alternative_cost_factor, args.cutoff_percentile)
+        except Exception as e:
+            errors[input_file] = f"{type(e).__name__}: {e}"
+            print(f"Error: {input_file}: {errors[input_file]}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
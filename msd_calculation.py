@@ -7,369 +7,2405 @@
 # - pandas
 # - matplotlib
 # - tqdm
+# - pyarrow (optional, for Parquet/Feather output)
 #
 # Install dependencies with:
 # pip install numpy pandas matplotlib tqdm
 
 import os
+import json
+import time
+import hashlib
+import tempfile
+import functools
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from tqdm import tqdm
 
-base_dir = "/your/data/path"
+# matplotlib is imported inside the plotting functions and tqdm on first use,
+# so importing this module for the numerical functions stays cheap
+def tqdm(*args, **kwargs):
+    from tqdm import tqdm as _tqdm
+    return _tqdm(*args, **kwargs)
+
+# Opt-in instrumentation: when enabled, every _stage() records wall time,
+# peak RSS, rows/tracks processed and throughput into _RUN_RECORDS
+_RUN_RECORDS = None
+_OPEN_STAGES = []
+
+def enable_instrumentation():
+    global _RUN_RECORDS
+    _RUN_RECORDS = []
+
+def instrumentation_enabled():
+    return _RUN_RECORDS is not None
+
+def instrumentation_records():
+    return list(_RUN_RECORDS or [])
+
+def _add_records(records):
+    # Records collected in worker processes
+    if _RUN_RECORDS is not None:
+        _RUN_RECORDS.extend(records)
+
+def _peak_rss_mb():
+    # Peak resident set size: VmHWM on Linux (resettable per stage), else ru_maxrss
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        return None
+
+def _reset_peak_rss():
+    # Linux only: writing 5 to clear_refs resets VmHWM to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+@contextlib.contextmanager
+def _stage(name, file_name=None):
+    # Yields a dict where the caller sets "rows"/"tracks"; recorded only when
+    # instrumentation is enabled
+    record = {"stage": name, "file": file_name, "rows": None, "tracks": None}
+    if _RUN_RECORDS is None:
+        yield record
+        return
 
-def make_msd_csv(file_name, time_interval, output_folder):
+    # Carry the peak so far into the enclosing stage before resetting it
+    if _OPEN_STAGES:
+        parent = _OPEN_STAGES[-1]
+        parent["_peak"] = max(parent.get("_peak") or 0, _peak_rss_mb() or 0)
+    _reset_peak_rss()
+    _OPEN_STAGES.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        _OPEN_STAGES.pop()
+        peak = max(record.pop("_peak", 0) or 0, _peak_rss_mb() or 0)
+        record["seconds"] = seconds
+        record["peak_rss_mb"] = peak or None
+        record["rows_per_s"] = record["rows"] / seconds if record["rows"] and seconds > 0 else None
+        if _OPEN_STAGES:
+            parent = _OPEN_STAGES[-1]
+            parent["_peak"] = max(parent.get("_peak") or 0, peak)
+        _RUN_RECORDS.append(record)
+
+def _instrumented(name):
+    # Record every call of the decorated function as stage `name`, keyed by its first argument
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with _stage(name, str(args[0]) if args else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _count(rows=None, tracks=None):
+    # Set the row/track counts of the innermost open stage
+    if _OPEN_STAGES:
+        if rows is not None:
+            _OPEN_STAGES[-1]["rows"] = int(rows)
+        if tracks is not None:
+            _OPEN_STAGES[-1]["tracks"] = int(tracks)
+
+def write_run_report(path):
+    # JSON or CSV (by extension) with one row per stage and file
+    records = instrumentation_records()
+    if path.endswith(".csv"):
+        pd.DataFrame(records, columns=["stage", "file", "seconds", "peak_rss_mb", "rows", "tracks",
+                                       "rows_per_s"]).to_csv(path, index=False)
+    else:
+        with open(path, "w") as f:
+            json.dump({"records": records}, f, indent=2)
+    print(f"Run report saved as {path}")
+
+def print_run_summary():
+    # Per-stage totals over all files
+    records = instrumentation_records()
+    if not records:
+        return
+    df = pd.DataFrame(records)
+    summary = df.groupby("stage", sort=False).agg(
+        calls=("seconds", "size"), seconds=("seconds", "sum"), peak_rss_mb=("peak_rss_mb", "max"),
+        rows=("rows", lambda v: v.sum(min_count=1)), tracks=("tracks", lambda v: v.sum(min_count=1)))
+    summary["rows_per_s"] = summary["rows"] / summary["seconds"].where(summary["seconds"] > 0)
+    print("Run summary:")
+    print(summary.to_string(float_format=lambda v: f"{v:,.2f}"))
+
+# Available MSD engines for make_msd_csv. "frames" takes lags from
+# POSITION_T, so tracks with skipped frames (gap closing) get correct lag
+# times; the others assume consecutive rows are one frame apart.
+MSD_METHODS = ("frames", "batched", "fft", "direct")
+
+# Tracks whose lag limit is at most this many lags are handled lag by lag in
+# _msd_batched instead of through the FFT, so lags past the limit are never computed
+BY_LAG_MAX = 64
+
+def _lag_limits(lengths, max_lag=None):
+    # Largest lag computed for each track: all lags (None), an absolute number
+    # of lags (int) or a fraction of the track length (float in (0, 1])
+    lengths = np.asarray(lengths)
+    full = np.maximum(lengths - 1, 0)
+    if max_lag is None:
+        return full
+    if isinstance(max_lag, float):
+        if not 0 < max_lag <= 1:
+            raise ValueError(f"Fractional max_lag must be in (0, 1], got {max_lag}")
+        return np.minimum(np.floor(max_lag * lengths).astype(int), full)
+    if max_lag < 0:
+        raise ValueError(f"max_lag must be non-negative, got {max_lag}")
+    return np.minimum(int(max_lag), full)
+
+def _msd_metadata_path(msd_file):
+    # Sidecar JSON next to an MSD/merged output (a_msd.csv -> a_msd.json)
+    return os.path.splitext(msd_file)[0] + ".json"
+
+def write_msd_metadata(msd_file, metadata):
+    with open(_msd_metadata_path(msd_file), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+def read_msd_metadata(msd_file):
+    # Empty dict for outputs written before metadata existed
+    path = _msd_metadata_path(msd_file)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+# Output table formats; Parquet and Feather (Arrow IPC) need pyarrow
+TABLE_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+# Columns stored dictionary-encoded in the binary formats
+DICTIONARY_COLUMNS = ("source_file",)
+
+def _table_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    for table_format, table_extension in TABLE_FORMATS.items():
+        if extension == table_extension:
+            return table_format
+    raise ValueError(f"Unsupported table format: {path} (use one of {', '.join(TABLE_FORMATS.values())})")
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.feather
+    except ImportError:
+        raise ImportError("Parquet/Feather output requires pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+def _compact_dtypes(df):
+    # 32-bit track IDs and lag times for the binary formats; positions and MSD
+    # stay float64. Fixed dtypes also keep the schema identical across batches.
+    df = df.copy()
+    if "TRACK_ID" in df.columns:
+        df["TRACK_ID"] = df["TRACK_ID"].astype(np.int32)
+    for col in ("POSITION_T", "interval"):
+        if col in df.columns:
+            df[col] = df[col].astype(np.float32)
+    for col in ("POSITION_X", "POSITION_Y", "msd"):
+        if col in df.columns:
+            df[col] = df[col].astype(np.float64)
+    return df
+
+class _TableWriter:
+    # Appends DataFrames to one CSV, Parquet or Feather file. Dictionary
+    # columns keep a growing dictionary so every batch is a delta of the
+    # previous one, which Arrow IPC files require.
+    def __init__(self, path):
+        self.path = path
+        self.format = _table_format(path)
+        self._writer = None
+        self._header = True
+        self._dictionaries = {}
+
+    def _to_arrow(self, df):
+        pa = _import_pyarrow()
+        df = _compact_dtypes(df)
+        columns = {}
+        for col in df.columns:
+            if col in DICTIONARY_COLUMNS:
+                known = self._dictionaries.setdefault(col, [])
+                new = [v for v in pd.unique(df[col].astype(str)) if v not in known]
+                known.extend(new)
+                codes = pd.Categorical(df[col].astype(str), categories=known).codes.astype(np.int32)
+                columns[col] = pa.DictionaryArray.from_arrays(pa.array(codes), pa.array(known, type=pa.string()))
+            else:
+                columns[col] = pa.array(df[col].values)
+        return pa.table(columns)
+
+    def write(self, df):
+        if self.format == "csv":
+            df.to_csv(self.path, index=False, mode="w" if self._header else "a", header=self._header)
+            self._header = False
+            return
+        pa = _import_pyarrow()
+        table = self._to_arrow(df)
+        if self._writer is None:
+            if self.format == "parquet":
+                self._writer = pa.parquet.ParquetWriter(self.path, table.schema)
+            else:
+                options = pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True)
+                self._writer = pa.ipc.new_file(self.path, table.schema, options=options)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+def write_msd_table(df, path):
+    writer = _TableWriter(path)
+    writer.write(df)
+    writer.close()
+
+def read_msd_table(path, columns=None):
+    # Load an MSD or merged table by extension; binary formats are memory-mapped
+    # and can load just the requested columns
+    table_format = _table_format(path)
+    if table_format == "csv":
+        return pd.read_csv(path, usecols=columns)
+    pa = _import_pyarrow()
+    if table_format == "parquet":
+        table = pa.parquet.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = pa.feather.read_table(path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+def _table_columns(path):
+    # Column names of a table without reading its rows
+    table_format = _table_format(path)
+    if table_format == "csv":
+        return list(pd.read_csv(path, nrows=0).columns)
+    pa = _import_pyarrow()
+    if table_format == "parquet":
+        return list(pa.parquet.read_schema(path).names)
+    with pa.memory_map(path) as source:
+        return list(pa.ipc.open_file(source).schema.names)
+
+def _msd_direct(positions, max_lag=None):
+    # Average squared displacement for every lag, one lag at a time (O(N^2))
+    n = len(positions)
+    msds = np.zeros(n)
+    last_lag = n - 1 if max_lag is None else min(max_lag, n - 1)
+    for i in range(1, last_lag + 1):
+        sd = np.sum(np.power(positions[i:] - positions[:-i], 2), axis=1)
+        msds[i] = np.average(sd)
+    return msds
+
+def _msd_fft(positions):
+    # Same result as _msd_direct using the FFT autocorrelation (O(N log N)):
+    # MSD(m) = S1(m) - 2 * S2(m), where S2 is the positional autocorrelation
+    # and S1 is obtained from cumulative sums of the squared positions.
+    n = len(positions)
+    if n < 2:
+        return np.zeros(n)
+
+    # Subtract the mean position to keep the FFT well conditioned
+    positions = positions - positions.mean(axis=0)
+
+    # Autocorrelation of each axis via zero-padded FFT
+    n_fft = 2 * n
+    spectrum = np.fft.rfft(positions, n=n_fft, axis=0)
+    acf = np.fft.irfft(spectrum * spectrum.conjugate(), n=n_fft, axis=0)[:n].sum(axis=1)
+    counts = n - np.arange(n)
+    s2 = acf / counts
+
+    sq = np.sum(positions ** 2, axis=1)
+    removed = np.concatenate(([0.0], np.cumsum(sq)[:-1] + np.cumsum(sq[::-1])[:-1]))
+    s1 = (2 * sq.sum() - removed) / counts
+
+    msds = s1 - 2 * s2
+    msds[0] = 0.0
+    # Clip round-off below zero for (nearly) stationary tracks
+    return np.maximum(msds, 0.0)
+
+def _track_offsets(track_ids):
+    # Start/end row offsets of each contiguous track in a TRACK_ID-sorted column
+    starts = np.flatnonzero(track_ids[1:] != track_ids[:-1]) + 1
+    return np.concatenate(([0], starts, [len(track_ids)]))
+
+def _msd_by_lag(positions, offsets, limits):
+    # Lag-by-lag MSD over the flat arrays: one vectorized pass per lag across
+    # all tracks, stopping at each track's limit
+    msds = np.zeros(len(positions))
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    track_index = np.repeat(np.arange(len(lengths)), lengths)
+
+    for lag in range(1, limits.max(initial=0) + 1):
+        pair_track = track_index[:-lag]
+        active = (pair_track == track_index[lag:]) & (limits[pair_track] >= lag)
+        sd = np.sum(np.power(positions[lag:][active] - positions[:-lag][active], 2), axis=1)
+        sums = np.bincount(pair_track[active], weights=sd, minlength=len(lengths))
+        tracks = np.flatnonzero(limits >= lag)
+        msds[starts[tracks] + lag] = sums[tracks] / (lengths[tracks] - lag)
+
+    return msds
+
+def _msd_batched(positions, offsets, limits=None):
+    # FFT MSD for all tracks at once. Tracks are bucketed by length (powers of
+    # two), zero-padded into a (tracks, length, 2) block and transformed together,
+    # so there is one NumPy pass per bucket instead of one Python call per track.
+    # The result is a flat array aligned with the rows of `positions`: row k of a
+    # track holds the MSD at lag k.
+    if limits is not None and limits.max(initial=0) <= BY_LAG_MAX:
+        return _msd_by_lag(positions, offsets, limits)
+
+    msds = np.zeros(len(positions))
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(int)
+
+    for bucket in np.unique(buckets):
+        selected = np.flatnonzero((buckets == bucket) & (lengths > 1))
+        if len(selected) == 0:
+            continue
+        n = lengths[selected][:, None]
+        width = n.max()
+        lags = np.arange(width)
+        valid = lags[None, :] < n
+        rows = starts[selected][:, None] + lags[None, :]
+        rows = np.where(valid, rows, 0)
+
+        # Padded, mean-centred positions (padding stays exactly zero)
+        block = positions[rows] * valid[:, :, None]
+        block -= (block.sum(axis=1) / n)[:, None, :]
+        block *= valid[:, :, None]
+
+        # Autocorrelation along the frame axis
+        n_fft = 2 * width
+        spectrum = np.fft.rfft(block, n=n_fft, axis=1)
+        acf = np.fft.irfft(spectrum * spectrum.conjugate(), n=n_fft, axis=1)[:, :width].sum(axis=2)
+
+        # S1(m) = sum_{i<n-m} sq[i] + sum_{i>=m} sq[i], from a cumulative sum
+        sq = np.sum(block ** 2, axis=2)
+        cum = np.concatenate((np.zeros((len(selected), 1)), np.cumsum(sq, axis=1)), axis=1)
+        head = np.take_along_axis(cum, np.maximum(n - lags[None, :], 0), axis=1)
+        tail = np.take_along_axis(cum, n, axis=1) - cum[:, :width]
+
+        counts = np.maximum(n - lags[None, :], 1)
+        result = np.maximum((head + tail - 2 * acf) / counts, 0.0)
+        result[:, 0] = 0.0
+        msds[rows[valid]] = result[valid]
+
+    return msds
+
+def _frame_index(times, offsets, time_interval, frames=None):
+    # Frame of every row relative to the first frame of its track, from the
+    # export's FRAME column when there is one, else from POSITION_T. Without
+    # a frame-interval calibration TrackMate writes POSITION_T in frames, which
+    # would make every track look like it skips frames; that is caught by
+    # refusing tables where no track ever advances by a single frame.
+    if frames is not None:
+        frames = np.asarray(frames).astype(np.int64)
+    else:
+        frames = np.rint(times / time_interval).astype(np.int64)
+        steps = np.diff(frames)
+        steps = steps[(steps > 0) & (np.diff(np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))) == 0)]
+        if len(steps) and steps.min() > 1:
+            raise ValueError(f"POSITION_T advances by at least {steps.min()} frames of {time_interval} s between "
+                             f"all consecutive spots; it is probably not in seconds (use the FRAME column, a "
+                             f"matching --time-interval or --method batched)")
+    return frames - np.repeat(frames[offsets[:-1]], np.diff(offsets))
+
+def _frame_positions(positions, offsets, frame_index):
+    # Frame-indexed flat copies of the tracks: entry span_offsets[t] + k is
+    # frame k of track t, with a presence mask for skipped frames (zero
+    # there). Positions are centred per track; a duplicated frame keeps its last row.
+    lengths = np.diff(offsets)
+    spans = frame_index[offsets[1:] - 1] + 1 if len(positions) else np.zeros(0, dtype=np.int64)
+    span_offsets = np.concatenate(([0], np.cumsum(spans)))
+    present = np.zeros(span_offsets[-1], dtype=bool)
+    frame_positions = np.zeros((span_offsets[-1], 2))
+    if len(positions) == 0:
+        return spans, span_offsets, present, frame_positions
+
+    slot = np.repeat(span_offsets[:-1], lengths) + frame_index
+    present[slot] = True
+    track_sums = np.zeros((len(lengths), 2))
+    np.add.at(track_sums, np.repeat(np.arange(len(lengths)), lengths), positions)
+    frame_positions[slot] = positions - np.repeat(track_sums / lengths[:, None], lengths, axis=0)
+    return spans, span_offsets, present, frame_positions
+
+def _msd_frames(positions, offsets, frame_index, limits):
+    # Gap-aware MSD. Each track is scattered into a frame-indexed block with
+    # a presence mask (missing frames are zero and masked out), so only pairs
+    # of observed frames contribute:
+    #   pairs(m) = sum_i p_i p_{i+m}
+    #   MSD(m)   = sum_i p_i p_{i+m} (|x_i|^2 + |x_{i+m}|^2 - 2 x_i.x_{i+m}) / pairs(m)
+    # Short lag limits are evaluated lag by lag; longer ones through FFT
+    # correlations, bucketed by span like _msd_batched. Returns flat MSD and
+    # pair-count arrays indexed by frame: entry span_offsets[t] + m is lag m
+    # of track t, for m up to the track's limit.
+    lengths = np.diff(offsets)
+    spans, span_offsets, present, frame_positions = _frame_positions(positions, offsets, frame_index)
+    msds = np.full(span_offsets[-1], np.nan)
+    pairs = np.zeros(span_offsets[-1], dtype=np.int64)
+    if len(positions) == 0:
+        return msds, pairs, span_offsets
+
+    if limits.max(initial=0) <= BY_LAG_MAX:
+        track_index = np.repeat(np.arange(len(spans)), spans)
+        msds[span_offsets[:-1]] = 0.0
+        pairs[span_offsets[:-1]] = lengths
+        for lag in range(1, limits.max(initial=0) + 1):
+            pair_track = track_index[:-lag]
+            active = (pair_track == track_index[lag:]) & present[:-lag] & present[lag:] & (limits[pair_track] >= lag)
+            sd = np.sum((frame_positions[lag:][active] - frame_positions[:-lag][active]) ** 2, axis=1)
+            sums = np.bincount(pair_track[active], weights=sd, minlength=len(spans))
+            counts = np.bincount(pair_track[active], minlength=len(spans))
+            tracks = np.flatnonzero(limits >= lag)
+            pairs[span_offsets[tracks] + lag] = counts[tracks]
+            with np.errstate(invalid="ignore"):
+                msds[span_offsets[tracks] + lag] = sums[tracks] / np.where(counts[tracks] > 0, counts[tracks], np.nan)
+        return msds, pairs, span_offsets
+
+    buckets = np.ceil(np.log2(np.maximum(spans, 1))).astype(int)
+    for bucket in np.unique(buckets):
+        selected = np.flatnonzero(buckets == bucket)
+        n = spans[selected][:, None]
+        width = n.max()
+        lags = np.arange(width)
+        valid = lags[None, :] < n
+        rows = np.where(valid, span_offsets[selected][:, None] + lags[None, :], 0)
+
+        mask = (present[rows] & valid).astype(float)
+        block = frame_positions[rows] * mask[:, :, None]
+        sq = np.sum(block ** 2, axis=2)
+
+        # corr(a, b)(m) = sum_i a_i b_{i+m}
+        n_fft = 2 * width
+        spectrum = np.fft.rfft(block, n=n_fft, axis=1)
+        mask_spectrum = np.fft.rfft(mask, n=n_fft, axis=1)
+        sq_spectrum = np.fft.rfft(sq, n=n_fft, axis=1)
+        acf = np.fft.irfft(spectrum.conjugate() * spectrum, n=n_fft, axis=1)[:, :width].sum(axis=2)
+        count = np.fft.irfft(mask_spectrum.conjugate() * mask_spectrum, n=n_fft, axis=1)[:, :width]
+        s1 = np.fft.irfft(sq_spectrum.conjugate() * mask_spectrum + mask_spectrum.conjugate() * sq_spectrum,
+                          n=n_fft, axis=1)[:, :width]
+
+        count = np.rint(count).astype(np.int64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = np.where(count > 0, np.maximum((s1 - 2 * acf) / count, 0.0), np.nan)
+        result[:, 0] = 0.0
+        within = valid & (lags[None, :] <= limits[selected][:, None])
+        msds[rows[within]] = result[within]
+        pairs[rows[within]] = count[within]
+
+    return msds, pairs, span_offsets
+
+# Observables make_msd_csv can derive from the lagged displacements besides
+# the per-track MSD: velocity autocorrelation, van Hove self-part histograms
+# and the non-Gaussian parameter
+OBSERVABLES = ("vacf", "van_hove", "ngp")
+
+# Default lags of the VACF (0..VACF_LAGS) and of the van Hove histograms
+VACF_LAGS = 20
+VAN_HOVE_LAGS = (1, 2, 4, 8, 16)
+
+# Default van Hove bins: VAN_HOVE_BINS bins over displacements -VAN_HOVE_RANGE..VAN_HOVE_RANGE per axis
+VAN_HOVE_RANGE = 2.0
+VAN_HOVE_BINS = 400
+
+def _msd_observables(positions, offsets, frame_index, limits, observables):
+    # Single pass over the lags for the frames method: the displacement array
+    # of each lag is built once, gives the per-track MSD (same result as
+    # _msd_frames) and is handed to the DisplacementObservables accumulator.
+    # Tracks are dropped from the working arrays once past their lag limit,
+    # so the cost is the number of pairs used rather than lags x rows.
+    # The VACF is built from the lag-1 displacements (frame-to-frame velocities).
+    lengths = np.diff(offsets)
+    spans, span_offsets, present, frame_positions = _frame_positions(positions, offsets, frame_index)
+    msds = np.full(span_offsets[-1], np.nan)
+    pairs = np.zeros(span_offsets[-1], dtype=np.int64)
+    if len(positions) == 0:
+        return msds, pairs, span_offsets
+    msds[span_offsets[:-1]] = 0.0
+    pairs[span_offsets[:-1]] = lengths
+
+    track_index = np.repeat(np.arange(len(spans)), spans)
+    slot_limits = limits[track_index]
+    slots = np.arange(span_offsets[-1])
+    steps = np.full((span_offsets[-1], 2), np.nan)
+    for lag in range(1, limits.max(initial=0) + 1):
+        live = slot_limits >= lag
+        if not live.all():
+            track_index, slot_limits, slots = track_index[live], slot_limits[live], slots[live]
+            present, frame_positions = present[live], frame_positions[live]
+
+        pair_track = track_index[:-lag]
+        active = (pair_track == track_index[lag:]) & present[:-lag] & present[lag:]
+        displacements = frame_positions[lag:][active] - frame_positions[:-lag][active]
+        sums = np.bincount(pair_track[active], weights=np.sum(displacements ** 2, axis=1), minlength=len(spans))
+        counts = np.bincount(pair_track[active], minlength=len(spans))
+        tracks = np.flatnonzero(limits >= lag)
+        pairs[span_offsets[tracks] + lag] = counts[tracks]
+        with np.errstate(invalid="ignore"):
+            msds[span_offsets[tracks] + lag] = sums[tracks] / np.where(counts[tracks] > 0, counts[tracks], np.nan)
+
+        observables.add_displacements(lag, displacements)
+        if lag == 1:
+            steps[slots[:-1][active]] = displacements
+
+    if "vacf" in observables.observables:
+        track_index = np.repeat(np.arange(len(spans)), spans)
+        for lag in range(min(observables.vacf_lags, len(steps) - 1) + 1):
+            end = len(steps) - lag
+            products = np.sum(steps[:end] * steps[lag:], axis=1)
+            products = products[(track_index[:end] == track_index[lag:]) & np.isfinite(products)]
+            observables.add_velocity_products(lag, products)
+
+    return msds, pairs, span_offsets
+
+# Lags (1..LOCAL_LAGS) of the rolling-window local MSD used for local D/alpha
+LOCAL_LAGS = 4
+
+# Features a local state threshold can apply to: "alpha" or "D"
+LOCAL_STATE_FEATURES = ("alpha", "D")
+
+def _local_msd(positions, offsets, frame_index, time_interval, window, lags=LOCAL_LAGS):
+    # Local D and alpha for every row: MSD at lags 1..lags over the `window`
+    # frames centred on the row, then a log-log fit as in fit_msd_table.
+    # Tracks are scattered into frame-indexed arrays (missing frames are NaN),
+    # each lag's squared displacements are averaged over all windows at once
+    # through a strided sliding-window view, and windows that do not fit inside
+    # the track give NaN.
+    if window <= lags:
+        raise ValueError(f"The local MSD window ({window} frames) must be longer than its lags ({lags})")
+    from numpy.lib.stride_tricks import sliding_window_view
+
+    lengths = np.diff(offsets)
+    if len(positions) == 0:
+        return np.zeros(0), np.zeros(0)
+    spans = frame_index[offsets[1:] - 1] + 1
+    span_offsets = np.concatenate(([0], np.cumsum(spans)))
+    slot = np.repeat(span_offsets[:-1], lengths) + frame_index
+    frame_positions = np.full((span_offsets[-1], 2), np.nan)
+    frame_positions[slot] = positions
+    track_of_slot = np.repeat(np.arange(len(spans)), spans)
+    frame_in_track = np.arange(span_offsets[-1]) - span_offsets[:-1][track_of_slot]
+    if span_offsets[-1] < window:
+        # No window fits (small file or streaming partition)
+        return np.full(len(positions), np.nan), np.full(len(positions), np.nan)
+
+    half = window // 2
+    local = np.full((lags, span_offsets[-1]), np.nan)
+    for lag in range(1, lags + 1):
+        sd = np.full(span_offsets[-1], np.nan)
+        same_track = track_of_slot[:-lag] == track_of_slot[lag:]
+        sd[:-lag] = np.where(same_track, np.sum((frame_positions[lag:] - frame_positions[:-lag]) ** 2, axis=1), np.nan)
+        # View s holds the pairs (i, i + lag) with both frames in [s, s + window - 1]
+        # (views past the last centre extend beyond the frames and are dropped)
+        views = sliding_window_view(sd, window - lag)[:span_offsets[-1] - half]
+        counts = np.sum(np.isfinite(views), axis=1)
+        with np.errstate(invalid="ignore"):
+            local[lag - 1, half:half + len(views)] = np.where(counts > 0, np.nansum(views, axis=1) / counts, np.nan)
+
+    inside = (frame_in_track >= half) & (frame_in_track + window - 1 - half < spans[track_of_slot])
+    local[:, ~inside] = np.nan
+    local = local[:, slot]
+
+    # Log-log least squares with the same lags for every row
+    x = np.log(np.arange(1, lags + 1) * time_interval)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = np.log(np.where(local > 0, local, np.nan))
+    x_centred = (x - x.mean())[:, None]
+    alpha = np.sum(x_centred * (y - y.mean(axis=0)), axis=0) / np.sum(x_centred ** 2)
+    local_D = np.exp(y.mean(axis=0) - alpha * x.mean()) / 4
+    return local_D, alpha
+
+def _local_states(local_D, local_alpha, state_threshold):
+    # Threshold segmentation: 1 (mobile) where the feature is at or above the
+    # threshold, 0 (confined) below it, -1 where it is undefined
+    feature, threshold = state_threshold
+    if feature not in LOCAL_STATE_FEATURES:
+        raise ValueError(f"Unknown state feature: {feature} (choose from {', '.join(LOCAL_STATE_FEATURES)})")
+    values = local_alpha if feature == "alpha" else local_D
+    states = np.where(values >= threshold, 1, 0).astype(np.int8)
+    states[~np.isfinite(values)] = -1
+    return states
+
+def _add_local_columns(df_tracks, offsets, time_interval, local_window, local_lags, state_threshold, frames=None):
+    # Insert local_D/local_alpha (and state) after POSITION_Y
+    frame_index = _frame_index(df_tracks["POSITION_T"].values, offsets, time_interval, frames)
+    positions = df_tracks[["POSITION_X", "POSITION_Y"]].values.astype(float)
+    local_D, local_alpha = _local_msd(positions, offsets, frame_index, time_interval, local_window, local_lags)
+    column = df_tracks.columns.get_loc("POSITION_Y") + 1
+    df_tracks.insert(column, "local_D", local_D)
+    df_tracks.insert(column + 1, "local_alpha", local_alpha)
+    if state_threshold is not None:
+        df_tracks.insert(column + 2, "state", _local_states(local_D, local_alpha, state_threshold))
+    return df_tracks
+
+# Columns read from TrackMate exports, with explicit dtypes for streaming mode
+TRACK_COLUMNS = ["TRACK_ID", "POSITION_T", "POSITION_X", "POSITION_Y"]
+TRACK_DTYPES = {"TRACK_ID": "float64", "POSITION_T": "float64", "POSITION_X": "float64", "POSITION_Y": "float64"}
+
+# Frame numbers of the spots, used for the lags when an export has them
+FRAME_COLUMN = "FRAME"
+
+def _frame_column(columns):
+    return [FRAME_COLUMN] if FRAME_COLUMN in columns else []
+
+# Binary spot exports written by Trackmate.py (export_format='npz'): one
+# full-precision array per column, sorted by TRACK_ID and frame, with the
+# time interval and calibration in a .json sidecar
+SPOT_ARRAY_EXTENSION = ".npz"
+
+# Inputs picked up by process_working_dir
+INPUT_EXTENSIONS = (".csv", SPOT_ARRAY_EXTENSION)
+
+def read_spot_arrays(path):
+    # Track columns of a .npz spot export and its metadata. The export is
+    # already track-sorted, so the sort only runs for files that are not.
+    metadata = read_msd_metadata(path)
+    with np.load(path) as data:
+        df_tracks = pd.DataFrame({col: data[col] for col in TRACK_COLUMNS + _frame_column(data.files)})
+    # Spots not in any track (TRACK_ID -1 or missing) are dropped
+    df_tracks = df_tracks[df_tracks["TRACK_ID"] >= 0]
+
+    track_ids, times = df_tracks["TRACK_ID"].values, df_tracks["POSITION_T"].values
+    same_track = track_ids[1:] == track_ids[:-1]
+    if not np.all((track_ids[1:] > track_ids[:-1]) | (same_track & (times[1:] > times[:-1]))):
+        df_tracks = df_tracks.sort_values(by=["TRACK_ID", "POSITION_T"])
+    return df_tracks.reset_index(drop=True), metadata
+
+# Number of consecutive TRACK_IDs spilled to the same partition in streaming mode
+TRACKS_PER_PARTITION = 1000
+
+def _empty_msd_table(method, local_window=None, state_threshold=None):
+    # No tracked spots: an empty table with the usual columns
+    local_columns = ["local_D", "local_alpha"] + (["state"] if state_threshold is not None else [])
+    columns = (TRACK_COLUMNS + (local_columns if local_window is not None else []) + ["interval", "msd"]
+               + (["n_pairs"] if method == "frames" else []))
+    empty = pd.DataFrame({col: pd.Series(dtype="float64") for col in columns})
+    return empty.astype({col: np.int64 for col in ("TRACK_ID", "n_pairs") if col in columns})
+
+def _compute_msd_table(df_tracks, time_interval, method="frames", max_lag=None, local_window=None,
+                       local_lags=LOCAL_LAGS, state_threshold=None, observables=None):
+    # MSD columns for a TRACK_ID/POSITION_T-sorted table of complete tracks.
+    # Returns the output table and the lag limit of each track.
+    # local_window adds per-frame local_D/local_alpha (and, with
+    # state_threshold = (feature, value), a state column); every spot row is
+    # then kept, with an empty interval/msd past the track's lag limit.
+    # observables (a DisplacementObservables, frames method only) is fed the
+    # same lagged displacements the MSD is computed from. A FRAME column, if
+    # present, gives the frame numbers and is not written out.
     def _calc_msd(df, interval):
-        msds = np.zeros(1)
-        for i in range(1, len(df)):
-            sd = 0
-            for col in ["POSITION_X", "POSITION_Y"]:
-                x = df[col].values
-                sd += np.power((x[i:] - x[:-i]), 2)
-            msds = np.append(msds, np.average(sd))
-        intervals = np.append(np.zeros(1), range(1, len(df))) * interval
+        positions = df[["POSITION_X", "POSITION_Y"]].values
+        limit = int(_lag_limits([len(df)], max_lag)[0])
+        if method == "fft":
+            msds = _msd_fft(positions)
+        else:
+            msds = _msd_direct(positions, limit)
+        intervals = np.arange(len(df)) * interval
         df = pd.DataFrame({"interval": intervals, "msd": msds})
         return df.reset_index(drop=True)
 
-    df_tracks = pd.read_csv(file_name, header=0, skiprows=[1, 2, 3, 4])
+    if len(df_tracks) == 0:
+        return _empty_msd_table(method, local_window, state_threshold), np.zeros(0, dtype=np.int64)
+
+    frames = None
+    if FRAME_COLUMN in df_tracks:
+        frames = df_tracks[FRAME_COLUMN].values
+        df_tracks = df_tracks.drop(columns=FRAME_COLUMN)
+
+    # Row k of each track holds lag k; rows past the track's lag limit are not written
+    track_ids = df_tracks["TRACK_ID"].values
+    offsets = _track_offsets(track_ids)
+    lengths = np.diff(offsets)
 
-    df_tracks = df_tracks[["TRACK_ID", "POSITION_T", "POSITION_X", "POSITION_Y"]]
-    df_tracks = df_tracks.sort_values(by=["TRACK_ID", "POSITION_T"])
-    df_tracks = df_tracks.reset_index(drop=True)
+    if local_window is not None:
+        df_tracks = _add_local_columns(df_tracks, offsets, time_interval, local_window, local_lags, state_threshold,
+                                       frames)
 
-    grouped = df_tracks.groupby(["TRACK_ID"], as_index=False, group_keys=False)
-    df_new = grouped.apply(lambda x: _calc_msd(x, time_interval)).reset_index(drop=True)
+    if method == "frames":
+        return _compute_frame_msd_table(df_tracks, offsets, time_interval, max_lag,
+                                        keep_spots=local_window is not None, observables=observables, frames=frames)
+    if observables is not None:
+        raise ValueError("Displacement observables need the frames MSD method")
 
-    df = pd.concat([df_tracks, df_new], axis=1)
+    limits = _lag_limits(lengths, max_lag)
+    frame_index = np.arange(len(df_tracks)) - np.repeat(offsets[:-1], lengths)
+    keep = frame_index <= np.repeat(limits, lengths)
+
+    if method == "batched":
+        # Work on the flat sorted columns
+        positions = df_tracks[["POSITION_X", "POSITION_Y"]].values.astype(float)
+
+        df = df_tracks
+        df["interval"] = frame_index * time_interval
+        df["msd"] = _msd_batched(positions, offsets, limits)
+    else:
+        grouped = df_tracks.groupby(["TRACK_ID"], as_index=False, group_keys=False)
+        df_new = grouped.apply(lambda x: _calc_msd(x, time_interval)).reset_index(drop=True)
+
+        df = pd.concat([df_tracks, df_new], axis=1)
+
+    if local_window is not None:
+        df.loc[~keep, ["interval", "msd"]] = np.nan
+    elif not keep.all():
+        df = df[keep].reset_index(drop=True)
+    return df, limits
+
+def _compute_frame_msd_table(df_tracks, offsets, time_interval, max_lag, keep_spots=False, observables=None,
+                             frames=None):
+    # Gap-aware version of the table: one row per lag 0..limit, where the
+    # limit follows from the track's span in frames. Spot k of the track stays
+    # on row k as in the other methods; lag rows beyond the last spot (only
+    # possible with gaps) have empty position columns. n_pairs is the number
+    # of frame pairs behind each MSD value (0, with an empty MSD, when no
+    # pair of observed frames is that far apart). keep_spots also keeps the
+    # spot rows past the lag limit, with an empty interval/msd.
+    lengths = np.diff(offsets)
+    frame_index = _frame_index(df_tracks["POSITION_T"].values, offsets, time_interval, frames)
+    positions = df_tracks[["POSITION_X", "POSITION_Y"]].values.astype(float)
+    spans = frame_index[offsets[1:] - 1] + 1 if len(df_tracks) else np.zeros(0, dtype=np.int64)
+    limits = _lag_limits(spans, max_lag)
+    if observables is not None:
+        msds, pairs, span_offsets = _msd_observables(positions, offsets, frame_index, limits, observables)
+    else:
+        msds, pairs, span_offsets = _msd_frames(positions, offsets, frame_index, limits)
+
+    rows_per_track = limits + 1 if len(df_tracks) else np.zeros(0, dtype=np.int64)
+    if keep_spots:
+        rows_per_track = np.maximum(rows_per_track, lengths)
+    track = np.repeat(np.arange(len(lengths)), rows_per_track)
+    lag = np.arange(rows_per_track.sum()) - np.repeat(np.cumsum(rows_per_track) - rows_per_track, rows_per_track)
+    has_spot = lag < lengths[track]
+    spot_rows = np.where(has_spot, offsets[:-1][track] + lag, 0)
+    within_limit = lag <= limits[track]
+    lag_rows = span_offsets[:-1][track] + np.where(within_limit, lag, 0)
+
+    df = pd.DataFrame({"TRACK_ID": df_tracks["TRACK_ID"].values[offsets[:-1]][track]})
+    spot_columns = [col for col in df_tracks.columns if col != "TRACK_ID"]
+    for col in spot_columns:
+        values = df_tracks[col].values[spot_rows]
+        if col == "state":
+            df[col] = np.where(has_spot, values, -1).astype(np.int8)
+        else:
+            df[col] = np.where(has_spot, values.astype(float), np.nan)
+    df["interval"] = np.where(within_limit, lag * time_interval, np.nan)
+    df["msd"] = np.where(within_limit, msds[lag_rows], np.nan)
+    df["n_pairs"] = np.where(within_limit, pairs[lag_rows], 0)
+    return df, limits
+
+def _spill_track_partitions(file_name, spill_dir, chunksize, columns=TRACK_COLUMNS):
+    # First streaming pass: read the needed columns chunk by chunk and append
+    # each row, as raw float64, to the partition file of its TRACK_ID range.
+    # A track therefore ends up complete in one partition whatever the row order.
+    partitions = set()
+    reader = pd.read_csv(file_name, header=0, skiprows=[1, 2, 3, 4], usecols=columns,
+                         dtype={col: TRACK_DTYPES.get(col, "float64") for col in columns}, chunksize=chunksize)
+    for chunk in reader:
+        values = chunk[columns].dropna(subset=["TRACK_ID"]).values
+        keys = (values[:, 0] // TRACKS_PER_PARTITION).astype(np.int64)
+        order = np.argsort(keys, kind="stable")
+        values, keys = values[order], keys[order]
+        bounds = np.flatnonzero(np.diff(keys)) + 1
+        for part in np.split(np.arange(len(keys)), bounds):
+            if len(part) == 0:
+                continue
+            key = int(keys[part[0]])
+            with open(os.path.join(spill_dir, f"part_{key}.bin"), "ab") as f:
+                values[part].tofile(f)
+            partitions.add(key)
+    return sorted(partitions)
+
+def _stream_msd_table(file_name, time_interval, output_file, method, max_lag, chunksize, local_window=None,
+                      local_lags=LOCAL_LAGS, state_threshold=None, observables=None):
+    # Second pass: load one partition at a time, sort it, compute its MSD and
+    # append the rows to the output, so only one chunk or one partition of
+    # tracks is ever held in memory. Partitions are visited in TRACK_ID order,
+    # giving the same row order as the in-memory path.
+    max_lag_frames = 0
+    n_rows = n_tracks = 0
+    writer = _TableWriter(output_file)
+    columns = TRACK_COLUMNS + _frame_column(pd.read_csv(file_name, nrows=0).columns)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file)) as spill_dir:
+        with _stage("read_csv", file_name):
+            partitions = _spill_track_partitions(file_name, spill_dir, chunksize, columns)
+
+        for key in partitions:
+            values = np.fromfile(os.path.join(spill_dir, f"part_{key}.bin")).reshape(-1, len(columns))
+            values = values[np.lexsort((values[:, 1], values[:, 0]))]
+            df_tracks = pd.DataFrame(values, columns=columns)
+            df_tracks["TRACK_ID"] = df_tracks["TRACK_ID"].astype(np.int64)
+
+            df, limits = _compute_msd_table(df_tracks, time_interval, method, max_lag, local_window, local_lags,
+                                            state_threshold, observables)
+            writer.write(df)
+            max_lag_frames = max(max_lag_frames, int(limits.max(initial=0)))
+            n_rows += len(df_tracks)
+            n_tracks += len(limits)
+
+        if not partitions:
+            writer.write(_empty_msd_table(method, local_window, state_threshold))
+    writer.close()
+
+    return max_lag_frames, n_rows, n_tracks
+
+def make_msd_csv(file_name, time_interval, output_folder, method="frames", max_lag=None, chunksize=None,
+                 output_format="csv", local_window=None, local_lags=LOCAL_LAGS, state_threshold=None,
+                 observables=None, van_hove_lags=VAN_HOVE_LAGS, vacf_lags=VACF_LAGS,
+                 van_hove_range=VAN_HOVE_RANGE, van_hove_bins=VAN_HOVE_BINS):
+    # With chunksize set, the export is streamed instead of loaded whole.
+    # output_format selects the table written: "csv", "parquet" or "feather".
+    # .npz spot exports from Trackmate.py are loaded directly (chunksize is
+    # not needed) and their recorded time interval, which POSITION_T is based
+    # on, takes precedence over the time_interval argument.
+    # local_window (frames) adds per-frame local_D/local_alpha columns from a
+    # rolling-window MSD over lags 1..local_lags; state_threshold, e.g.
+    # ("alpha", 0.6), adds a state column (1 mobile, 0 confined, -1 unknown).
+    # observables, a subset of OBSERVABLES, are derived in the same pass over
+    # the lagged displacements as the MSD (frames method) and written next to
+    # the MSD table as <input>_vacf/_van_hove/_ngp tables, accumulated over all
+    # tracks of the file, plus a mergeable <input>_observables.npz.
+    if method not in MSD_METHODS:
+        raise ValueError(f"Unknown MSD method: {method} (choose from {', '.join(MSD_METHODS)})")
+    if output_format not in TABLE_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format} (choose from {', '.join(TABLE_FORMATS)})")
+    if observables and method != "frames":
+        raise ValueError(f"Displacement observables need the frames MSD method, not {method}")
 
     # Ensure the output folder exists
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    output_file = os.path.join(output_folder, os.path.basename(file_name).replace(".csv", "_msd.csv"))
-    df.to_csv(output_file, index=False)
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    output_file = os.path.join(output_folder, stem + "_msd" + TABLE_FORMATS[output_format])
+    spot_arrays = file_name.endswith(SPOT_ARRAY_EXTENSION)
+    accumulator = (DisplacementObservables(None, observables, van_hove_lags, vacf_lags, van_hove_range,
+                                           van_hove_bins) if observables else None)
+
+    with _stage("make_msd_csv", file_name) as record:
+        if chunksize is not None and not spot_arrays:
+            max_lag_frames, record["rows"], record["tracks"] = _stream_msd_table(
+                file_name, time_interval, output_file, method, max_lag, chunksize, local_window, local_lags,
+                state_threshold, accumulator)
+        else:
+            with _stage("read_csv", file_name) as read_record:
+                if spot_arrays:
+                    df_tracks, spot_metadata = read_spot_arrays(file_name)
+                    recorded = spot_metadata.get("time_interval")
+                    if recorded is not None and not np.isclose(recorded, time_interval or recorded):
+                        print(f"Note: using the recorded time interval {recorded} of {file_name} "
+                              f"instead of {time_interval}")
+                    time_interval = recorded or time_interval
+                else:
+                    df_tracks = pd.read_csv(file_name, header=0, skiprows=[1, 2, 3, 4])
+
+                    df_tracks = df_tracks[TRACK_COLUMNS + _frame_column(df_tracks.columns)]
+                    # Spots not in any track are dropped, as in the streaming path
+                    df_tracks = df_tracks.dropna(subset=["TRACK_ID"]).astype({"TRACK_ID": np.int64})
+                    df_tracks = df_tracks.sort_values(by=["TRACK_ID", "POSITION_T"])
+                    df_tracks = df_tracks.reset_index(drop=True)
+                read_record["rows"] = record["rows"] = len(df_tracks)
+
+            with _stage("msd", file_name) as msd_record:
+                df, limits = _compute_msd_table(df_tracks, time_interval, method, max_lag, local_window, local_lags,
+                                                state_threshold, accumulator)
+                msd_record["rows"] = record["rows"]
+                msd_record["tracks"] = record["tracks"] = len(limits)
+
+            with _stage("write_msd_table", output_file) as write_record:
+                write_msd_table(df, output_file)
+                write_record["rows"] = len(df)
+            max_lag_frames = int(limits.max(initial=0))
+
+        if accumulator is not None:
+            with _stage("write_observables", output_file):
+                accumulator.time_interval = time_interval
+                write_observables(accumulator, output_folder, stem, output_format)
+        else:
+            # Don't let an earlier run's observables be merged with this run's MSD
+            remove_observables(output_folder, stem)
+
+    # Record how the file was made so merge/plot steps don't need to re-derive it
+    write_msd_metadata(output_file, {
+        "time_interval": time_interval,
+        "method": method,
+        "max_lag": max_lag,
+        "max_lag_frames": max_lag_frames,
+        "local_window": local_window,
+        "local_lags": local_lags if local_window is not None else None,
+        "state_threshold": list(state_threshold) if local_window is not None and state_threshold else None,
+        "observables": list(accumulator.observables) if accumulator is not None else None,
+        "van_hove_lags": list(van_hove_lags) if observables and "van_hove" in observables else None,
+        "van_hove_range": van_hove_range if observables and "van_hove" in observables else None,
+        "van_hove_bins": van_hove_bins if observables and "van_hove" in observables else None,
+        "vacf_lags": vacf_lags if observables and "vacf" in observables else None,
+    })
     return output_file
 
-def plot_msd(file_name, output_folder):
-    # Read the MSD data from the CSV file
-    df = pd.read_csv(file_name)
+# Per-track plot outputs of plot_msd: one PNG per track, tiled contact sheets or one multi-page PDF
+PLOT_LAYOUTS = ("png", "sheet", "pdf")
 
-    # Get unique track IDs
-    unique_track_ids = df["TRACK_ID"].unique()
+def _track_figure(rows=1, cols=1):
+    # Figure on its own Agg canvas (no pyplot state), with one empty line per tile
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if rows == 1 and cols == 1:
+        fig = Figure()
+    else:
+        # Fixed margins (in inches, converted to figure fractions) instead of a
+        # layout engine, which would re-solve the layout on every save
+        width, height = 3.2 * cols, 2.4 * rows
+        fig = Figure(figsize=(width, height))
+        fig.subplots_adjust(left=0.6 / width, right=1 - 0.15 / width, bottom=0.45 / height, top=1 - 0.3 / height,
+                            wspace=0.4, hspace=0.6)
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(rows, cols, squeeze=False).ravel()
+    lines = [ax.plot([], [])[0] for ax in axes]
+    return fig, axes, lines
+
+def _draw_track(ax, line, track_id, intervals, msds, small=False):
+    # Only the line data, limits and title change between tracks
+    line.set_data(intervals, msds)
+    ax.relim()
+    ax.autoscale_view()
+    ax.set_xlabel("Time Interval")
+    ax.set_ylabel("MSD")
+    if small:
+        ax.set_title(f"Track {track_id}", fontsize="small")
+    else:
+        ax.set_title(f"Mean Squared Displacement (MSD) for Track {track_id}")
+
+def _render_track_pngs(output_folder, track_ids, offsets, intervals, msds):
+    # One PNG per track, all drawn on the same reused figure
+    fig, axes, lines = _track_figure()
+    for i, track_id in enumerate(track_ids):
+        start, stop = offsets[i] - offsets[0], offsets[i + 1] - offsets[0]
+        _draw_track(axes[0], lines[0], track_id, intervals[start:stop], msds[start:stop])
+        fig.savefig(os.path.join(output_folder, f"track_{track_id}_msd.png"))
+    return len(track_ids)
+
+def _render_track_sheets(sheet_files, sheet_shape, track_ids, offsets, intervals, msds):
+    # Tile rows x cols tracks onto each contact sheet, all drawn on the same
+    # reused figure; only the line data and titles change between sheets
+    fig, axes, lines = _track_figure(*sheet_shape)
+    per_sheet = len(axes)
+    for n, sheet_file in enumerate(sheet_files):
+        for j, (ax, line) in enumerate(zip(axes, lines)):
+            i = n * per_sheet + j
+            ax.set_visible(i < len(track_ids))
+            if i < len(track_ids):
+                start, stop = offsets[i] - offsets[0], offsets[i + 1] - offsets[0]
+                _draw_track(ax, line, track_ids[i], intervals[start:stop], msds[start:stop], small=True)
+        fig.savefig(sheet_file)
+    return len(track_ids)
+
+@_instrumented("plot_msd")
+def plot_msd(file_name, output_folder, progress=True, layout="png", workers=1, sheet_shape=(5, 5)):
+    # layout="png" writes track_<id>_msd.png per track, "sheet" writes
+    # rows x cols contact sheets and "pdf" one page per track in a single PDF.
+    # PNGs and sheets are spread over `workers` processes.
+    if layout not in PLOT_LAYOUTS:
+        raise ValueError(f"Unknown plot layout: {layout} (choose from {', '.join(PLOT_LAYOUTS)})")
+
+    # Read the MSD data from the CSV/Parquet/Feather file
+    df = read_msd_table(file_name, columns=["TRACK_ID", "interval", "msd"])
+
+    # Index the tracks once: contiguous rows per TRACK_ID plus group offsets
+    track_column = df["TRACK_ID"].values
+    if not df["TRACK_ID"].is_monotonic_increasing:
+        order = np.argsort(track_column, kind="stable")
+        df = df.iloc[order]
+        track_column = track_column[order]
+    offsets = _track_offsets(track_column)
+    unique_track_ids = track_column[offsets[:-1]]
+    _count(rows=len(df), tracks=len(unique_track_ids))
+    intervals = df["interval"].values
+    msds = df["msd"].values
 
     # Create an output folder within the specified working directory if it doesn't exist
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    # Initialize tqdm progress bar
-    progress_bar = tqdm(total=len(unique_track_ids), desc="Plotting")
+    stem = os.path.splitext(os.path.basename(file_name))[0]
 
-    # Plot MSD for each track ID and save the plot in the output folder
-    for track_id in unique_track_ids:
-        track_data = df[df["TRACK_ID"] == track_id]
-        plt.plot(track_data["interval"], track_data["msd"], label=f"Track {track_id}")
+    # Initialize tqdm progress bar (disabled when a batch driver shows its own)
+    progress_bar = tqdm(total=len(unique_track_ids), desc="Plotting", disable=not progress)
 
-        # Save the plot in the output folder
-        plt.xlabel("Time Interval")
-        plt.ylabel("MSD")
-        plt.title(f"Mean Squared Displacement (MSD) for Track {track_id}")
-        plt.savefig(os.path.join(output_folder, f"track_{track_id}_msd.png"))
-        plt.close()
+    if layout == "pdf":
+        from matplotlib.backends.backend_pdf import PdfPages
 
-        # Update progress bar
-        progress_bar.update(1)
+        fig, axes, lines = _track_figure()
+        with PdfPages(os.path.join(output_folder, f"{stem}_tracks.pdf")) as pdf:
+            for i, track_id in enumerate(unique_track_ids):
+                start, stop = offsets[i], offsets[i + 1]
+                _draw_track(axes[0], lines[0], track_id, intervals[start:stop], msds[start:stop])
+                pdf.savefig(fig)
+                progress_bar.update(1)
+        progress_bar.close()
+        return
+
+    # Split the tracks into a few batches per worker (whole sheets for contact sheets)
+    batch_size = max(1, min(500, -(-len(unique_track_ids) // (4 * (workers or os.cpu_count() or 1)))))
+    if layout == "sheet":
+        per_sheet = sheet_shape[0] * sheet_shape[1]
+        batch_size = -(-batch_size // per_sheet) * per_sheet
+    jobs = []
+    for first in range(0, len(unique_track_ids), batch_size):
+        last = min(first + batch_size, len(unique_track_ids))
+        start, stop = offsets[first], offsets[last]
+        data = (unique_track_ids[first:last], offsets[first:last + 1], intervals[start:stop], msds[start:stop])
+        if layout == "sheet":
+            sheet_files = [os.path.join(output_folder, f"{stem}_sheet_{n + 1:04d}.png")
+                           for n in range(first // per_sheet, -(-last // per_sheet))]
+            jobs.append((_render_track_sheets, (sheet_files, sheet_shape) + data))
+        else:
+            jobs.append((_render_track_pngs, (output_folder,) + data))
+
+    if workers == 1:
+        for function, args in jobs:
+            progress_bar.update(function(*args))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(function, *args) for function, args in jobs]
+            for future in as_completed(futures):
+                progress_bar.update(future.result())
 
     # Close the progress bar
     progress_bar.close()
 
-# Set the working directory (replace with your specific working directory)
-working_dir = "/Users/yourname/data"      # Rename this path as needed
-time_interval = 0.2  # seconds
-
-# Traverse through the working directory and its subfolders
-for root, dirs, files in os.walk(working_dir):
-    # Search for all CSV files in the current directory
-    csv_files = [os.path.join(root, x) for x in files if x.endswith(".csv")]
-
-    # Check if there are any CSV files
-    if len(csv_files) == 0:
-        print(f"ERROR: There are no CSV files in {root}")
+# Folders written by this script; they are never scanned for input CSVs
+OUTPUT_FOLDERS = ("msd_csv", "msd_plots", "msd_merge")
+
+# Manifest kept in the working directory for incremental re-runs
+MANIFEST_NAME = "msd_manifest.json"
+
+def _file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(root):
+    path = os.path.join(root, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"inputs": {}, "merges": {}, "plots": {}}
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest.setdefault("inputs", {})
+    manifest.setdefault("merges", {})
+    manifest.setdefault("plots", {})
+    return manifest
+
+def save_manifest(root, manifest):
+    # Write to a temporary file first so an interrupted run can't leave a truncated manifest
+    path = os.path.join(root, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def _input_fingerprint(csv_file, previous):
+    # Content hash of an input, reusing the recorded hash when size and mtime
+    # are unchanged so unchanged multi-GB exports are not re-read
+    stat = os.stat(csv_file)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        sha256 = previous["sha256"]
     else:
-        # Process each CSV file
+        sha256 = _file_sha256(csv_file)
+    return {"sha256": sha256, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def _process_csv_file(csv_file, time_interval, max_lag=None, chunksize=None, method="frames",
+                      output_format="csv", plot_layout="png", instrument=False, profile_output=None,
+                      local_window=None, local_lags=LOCAL_LAGS, state_threshold=None, observables=None,
+                      van_hove_lags=VAN_HOVE_LAGS, vacf_lags=VACF_LAGS, van_hove_range=VAN_HOVE_RANGE,
+                      van_hove_bins=VAN_HOVE_BINS):
+    # MSD CSV and per-track plots for one input; output paths depend only on the input path.
+    # Returns the MSD table path and the instrumentation records made for this
+    # file (so worker processes can hand them back); profile_output dumps a cProfile.
+    if instrument and not instrumentation_enabled():
+        enable_instrumentation()
+    first_record = len(_RUN_RECORDS) if instrument else 0
+
+    profiler = None
+    if profile_output is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        root = os.path.dirname(csv_file)
+
+        # Create an output folder for MSD CSVs within the current subfolder
+        msd_csv_output_folder = os.path.join(root, "msd_csv")
+        msd_csv_file = make_msd_csv(csv_file, time_interval, msd_csv_output_folder, method=method,
+                                    max_lag=max_lag, chunksize=chunksize, output_format=output_format,
+                                    local_window=local_window, local_lags=local_lags, state_threshold=state_threshold,
+                                    observables=observables, van_hove_lags=van_hove_lags, vacf_lags=vacf_lags,
+                                    van_hove_range=van_hove_range, van_hove_bins=van_hove_bins)
+
+        # Create an output folder for MSD plots within the current subfolder (plot_layout=None skips them)
+        if plot_layout is not None:
+            plot_output_folder = os.path.join(root, "msd_plots")
+            plot_msd(msd_csv_file, plot_output_folder, progress=False, layout=plot_layout)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_output)
+
+    records = _RUN_RECORDS[first_record:] if instrument else []
+    return msd_csv_file, records
+
+def process_working_dir(working_dir, time_interval, max_lag=None, chunksize=None, workers=None,
+                        method="frames", incremental=False, output_format="csv", plot_layout="png",
+                        profile_file=None, local_window=None, local_lags=LOCAL_LAGS, state_threshold=None,
+                        observables=None, van_hove_lags=VAN_HOVE_LAGS, vacf_lags=VACF_LAGS,
+                        van_hove_range=VAN_HOVE_RANGE, van_hove_bins=VAN_HOVE_BINS):
+    # Run _process_csv_file on every CSV below working_dir using a pool of
+    # `workers` processes (all cores if None, in-process if 1). Failures are
+    # collected and reported at the end instead of stopping the batch.
+    # profile_file (an input name or path) is run under cProfile, dumped next
+    # to the input as <name>.prof.
+    # With incremental=True, inputs whose content hash and parameters match
+    # the manifest, and whose outputs still exist, are skipped.
+    csv_files = []
+
+    # Traverse through the working directory and its subfolders
+    for root, dirs, files in os.walk(working_dir):
+        # Never descend into our own output folders
+        dirs[:] = sorted(d for d in dirs if d not in OUTPUT_FOLDERS)
+        # Search for all CSV files (and .npz spot exports) in the current directory
+        found = sorted(os.path.join(root, x) for x in files if x.endswith(INPUT_EXTENSIONS))
+
+        # Check if there are any CSV files
+        if len(found) == 0:
+            print(f"ERROR: There are no CSV files in {root}")
+        csv_files.extend(found)
+
+    params = {"time_interval": time_interval, "max_lag": max_lag, "method": method,
+              "output_format": output_format, "plot_layout": plot_layout}
+    if local_window is not None:
+        params.update({"local_window": local_window, "local_lags": local_lags,
+                       "state_threshold": list(state_threshold) if state_threshold else None})
+    if observables:
+        params.update({"observables": sorted(observables), "van_hove_lags": list(van_hove_lags),
+                       "vacf_lags": vacf_lags, "van_hove_range": van_hove_range, "van_hove_bins": van_hove_bins})
+    manifest = load_manifest(working_dir) if incremental else None
+    fingerprints = {}
+    skipped = []
+    if incremental:
+        pending = []
         for csv_file in csv_files:
-            print(f"Processing file: {csv_file}")
-
-            # Create an output folder for MSD CSVs within the current subfolder
-            msd_csv_output_folder = os.path.join(root, "msd_csv")
-            msd_csv_file = make_msd_csv(csv_file, time_interval, msd_csv_output_folder)
+            key = os.path.relpath(csv_file, working_dir)
+            previous = manifest["inputs"].get(key)
+            fingerprints[csv_file] = _input_fingerprint(csv_file, previous)
+            unchanged = (
+                previous is not None
+                and previous["sha256"] == fingerprints[csv_file]["sha256"]
+                and previous["params"] == params
+                and all(os.path.exists(os.path.join(working_dir, out)) for out in previous["outputs"])
+            )
+            if unchanged:
+                skipped.append(csv_file)
+            else:
+                pending.append(csv_file)
+        print(f"Skipping {len(skipped)} unchanged files.")
+    else:
+        pending = csv_files
+
+    instrument = instrumentation_enabled()
+
+    def _job_args(csv_file):
+        is_profiled = profile_file is not None and profile_file in (os.path.basename(csv_file), csv_file)
+        profile_output = os.path.splitext(csv_file)[0] + ".prof" if is_profiled else None
+        return (csv_file, time_interval, max_lag, chunksize, method, output_format, plot_layout, instrument,
+                profile_output, local_window, local_lags, state_threshold, observables, van_hove_lags, vacf_lags,
+                van_hove_range, van_hove_bins)
+
+    outputs = {}
+    errors = {}
+    progress_bar = tqdm(total=len(pending), desc="Processing files")
+
+    if workers == 1:
+        for csv_file in pending:
+            try:
+                # Records are already in this process's report
+                outputs[csv_file], _ = _process_csv_file(*_job_args(csv_file))
+            except Exception as e:
+                errors[csv_file] = f"{type(e).__name__}: {e}"
+            progress_bar.update(1)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(_process_csv_file, *_job_args(csv_file)): csv_file
+                for csv_file in pending
+            }
+            for future in as_completed(futures):
+                csv_file = futures[future]
+                try:
+                    outputs[csv_file], records = future.result()
+                    _add_records(records)
+                except Exception as e:
+                    errors[csv_file] = f"{type(e).__name__}: {e}"
+                progress_bar.update(1)
 
-            # Create an output folder for MSD plots within the current subfolder
-            plot_output_folder = os.path.join(root, "msd_plots")
-            plot_msd(msd_csv_file, plot_output_folder)
+    progress_bar.close()
 
-print("Processing completed.")
+    # Report failures once the whole batch has run
+    for csv_file in pending:
+        if csv_file in errors:
+            print(f"ERROR: Failed to process {csv_file}: {errors[csv_file]}")
+    print(f"Processed {len(outputs)} of {len(pending)} files ({len(errors)} failed).")
 
-def find_all_msd_csv(subfolder):
-    # Initialize a list to store paths of CSV files
+    if incremental:
+        # Record successful inputs; drop entries for inputs that no longer exist or failed
+        inputs = {}
+        for csv_file in csv_files:
+            key = os.path.relpath(csv_file, working_dir)
+            if csv_file in outputs:
+                msd_csv_file = outputs[csv_file]
+                produced = [msd_csv_file, _msd_metadata_path(msd_csv_file)]
+                if plot_layout is not None:
+                    produced.append(os.path.join(os.path.dirname(csv_file), "msd_plots"))
+                if observables:
+                    produced.append(os.path.join(os.path.dirname(msd_csv_file), os.path.splitext(
+                        os.path.basename(csv_file))[0] + OBSERVABLES_STATE_SUFFIX))
+                inputs[key] = dict(fingerprints[csv_file], params=params, outputs=[
+                    os.path.relpath(path, working_dir) for path in produced
+                ])
+            elif csv_file in skipped:
+                inputs[key] = dict(manifest["inputs"][key], **fingerprints[csv_file])
+        manifest["inputs"] = inputs
+        save_manifest(working_dir, manifest)
+
+    return [outputs[f] for f in pending if f in outputs], errors
+
+def find_all_msd_csv(subfolder, output_format="csv"):
+    # Initialize a list to store paths of MSD tables in one format (CSV,
+    # Parquet or Feather), so runs in another format are not merged in too
     msd_files = []
+    suffix = "_msd" + TABLE_FORMATS[output_format]
 
     # Walk through the subfolder
     for root, dirs, files in os.walk(subfolder):
-        for file in files:
-            if 'msd' in file and file.endswith('.csv'):
+        dirs.sort()
+        for file in sorted(files):
+            if file.endswith(suffix):
                 msd_files.append(os.path.join(root, file))
 
     return msd_files
 
-def merge_msd_csvs(subfolder, output_csv):
-    # Find all MSD CSV files in the specified subfolder
-    msd_files = find_all_msd_csv(subfolder)
+@_instrumented("merge_msd_csvs")
+def merge_msd_csvs(subfolder, output_csv, return_summary=False, output_format=None):
+    # Find all MSD CSV files in the specified subfolder (in the format of the
+    # merged output unless output_format is given)
+    msd_files = find_all_msd_csv(subfolder, output_format or _table_format(output_csv))
 
     # If no MSD CSV files are found, print an error message and return
     if not msd_files:
         print(f"Error: No MSD CSV files found in the subfolder {subfolder}.")
         return
 
-    # Initialize an empty DataFrame to hold all MSD data
-    merged_df = pd.DataFrame()
+    # Line the tables up by name: the union of their columns in first-seen
+    # order, where columns some tables lack (e.g. n_pairs of the frames
+    # method) are empty for the others and stored as float throughout
+    file_columns = [_table_columns(path) for path in msd_files]
+    for path, names in zip(msd_files, file_columns):
+        missing = [col for col in ("TRACK_ID", "interval", "msd") if col not in names]
+        if missing:
+            raise ValueError(f"Cannot merge {path}: not an MSD table (missing {', '.join(missing)})")
+    columns = list(dict.fromkeys(col for names in file_columns for col in names if col != "source_file"))
+    partial = [col for col in columns if not all(col in names for names in file_columns)]
+
+    # Stream each file into the output as it is read, so only one input is
+    # in memory at a time and every row is written exactly once
+    writer = _TableWriter(output_csv)
+    summary = []
+    ensemble = EnsembleMSD()
 
     # Iterate over each MSD file with progress bar
     for file_path in tqdm(msd_files, desc=f"Merging MSD files in {subfolder}"):
-        # Read the MSD data from the CSV file
-        df = pd.read_csv(file_path)
+        # Read the MSD data from the CSV/Parquet/Feather file
+        df = read_msd_table(file_path).reindex(columns=columns)
+        df[partial] = df[partial].astype(float)
         # Add a column to identify the source file
         df['source_file'] = os.path.basename(file_path)
-        # Append the data to the merged DataFrame
-        merged_df = pd.concat([merged_df, df], ignore_index=True)
-
-    # Save the merged DataFrame to a CSV file
-    merged_df.to_csv(output_csv, index=False)
-    print(f"Merged CSV saved as {output_csv}")
+        # Append the data to the merged output
+        writer.write(df)
+        summary.append({"source_file": os.path.basename(file_path),
+                        "tracks": int(df["TRACK_ID"].nunique()), "rows": len(df)})
+        # Fold the file into the per-lag ensemble statistics while it is in memory
+        time_interval = _msd_time_interval(file_path, df)
+        if time_interval is not None:
+            ensemble.add_table(df, time_interval)
+
+    writer.close()
+    write_ensemble_msd(ensemble, os.path.dirname(os.path.abspath(output_csv)))
+    _count(rows=sum(entry["rows"] for entry in summary), tracks=sum(entry["tracks"] for entry in summary))
+    write_msd_metadata(output_csv, _merge_metadata(msd_files, summary))
+    print(f"Merged table saved as {output_csv}")
+
+    if return_summary:
+        return pd.DataFrame(summary, columns=["source_file", "tracks", "rows"])
+
+def _merge_metadata(msd_files, summary):
+    # Combine the per-file metadata; the merged lag limit is only known if
+    # every input recorded one
+    metadata = [read_msd_metadata(path) for path in msd_files]
+    frames = [m.get("max_lag_frames") for m in metadata]
+    max_lags = {json.dumps(m.get("max_lag")) for m in metadata}
+    intervals = {m.get("time_interval") for m in metadata}
+    return {
+        "time_interval": intervals.pop() if len(intervals) == 1 else None,
+        "max_lag": json.loads(max_lags.pop()) if len(max_lags) == 1 else None,
+        "max_lag_frames": None if None in frames else max(frames),
+        "source_files": [os.path.basename(path) for path in msd_files],
+        "tracks_per_file": {entry["source_file"]: entry["tracks"] for entry in summary},
+    }
+
+# plot_merged_msd switches from one line per track to a density map above this many curves
+DENSITY_CURVE_THRESHOLD = 100000
+
+# Plot modes of plot_merged_msd
+MERGED_PLOT_MODES = ("auto", "lines", "density")
+
+def _group_merged_curves(merged_df, needs_cut, n_intervals=30):
+    # Sort the merged table into contiguous (source file, track) curves once.
+    # Returns the file names in order of appearance, the file index and row
+    # offsets of every curve, and the interval/msd columns in curve order.
+    file_codes, unique_files = pd.factorize(merged_df["source_file"])
+    track_ids = merged_df["TRACK_ID"].values
+    order = np.lexsort((track_ids, file_codes))
+    file_codes, track_ids = file_codes[order], track_ids[order]
+    intervals = merged_df["interval"].values[order]
+    msds = merged_df["msd"].values[order]
+
+    changes = (file_codes[1:] != file_codes[:-1]) | (track_ids[1:] != track_ids[:-1])
+    offsets = np.concatenate(([0], np.flatnonzero(changes) + 1, [len(order)]))
+
+    if needs_cut:
+        # Select first 30 intervals of every curve
+        lengths = np.diff(offsets)
+        rank = np.arange(len(order)) - np.repeat(offsets[:-1], lengths)
+        keep = rank <= n_intervals
+        intervals, msds = intervals[keep], msds[keep]
+        kept_lengths = np.minimum(lengths, n_intervals + 1)
+        file_codes = file_codes[offsets[:-1]]
+        offsets = np.concatenate(([0], np.cumsum(kept_lengths)))
+    else:
+        file_codes = file_codes[offsets[:-1]]
+
+    return list(unique_files), file_codes, offsets, intervals, msds
+
+def _draw_merged_lines(ax, unique_files, curve_files, offsets, intervals, msds, colors):
+    # One LineCollection per source file instead of one Line2D per track
+    from matplotlib.collections import LineCollection
+
+    points = np.column_stack((intervals, msds))
+    for i in tqdm(range(len(unique_files)), desc="Plotting MSD data"):
+        curves = np.flatnonzero(curve_files == i)
+        segments = [points[offsets[c]:offsets[c + 1]] for c in curves]
+        ax.add_collection(LineCollection(segments, colors=[colors(i)], alpha=0.7))
+    ax.autoscale_view()
+
+def _draw_merged_density(ax, unique_files, curve_files, offsets, intervals, msds, colors,
+                         x_limit=None, y_limit=None, bins=200):
+    # 2D histogram of MSD versus lag on log-log axes, with each file's median
+    # curve drawn on top in its usual color. Lag 0 and MSD 0 have no log value
+    # and are left out.
+    positive = (intervals > 0) & (msds > 0)
+    x, y = intervals[positive], msds[positive]
+    if len(x) == 0:
+        return
 
-def plot_merged_msd(output_csv, output_file, x_limit=None, y_limit=None):
-    # Read the merged MSD data from the CSV file
-    merged_df = pd.read_csv(output_csv)
+    def _log_edges(values, limit):
+        low, high = values.min(), values.max()
+        if limit is not None:
+            low = limit[0] if limit[0] > 0 else low
+            high = limit[1]
+        return np.logspace(np.log10(low), np.log10(max(high, low * 1.0001)), bins + 1)
+
+    x_edges, y_edges = _log_edges(x, x_limit), _log_edges(y, y_limit)
+    counts, _, _ = np.histogram2d(x, y, bins=(x_edges, y_edges))
+    mesh = ax.pcolormesh(x_edges, y_edges, np.ma.masked_equal(counts.T, 0), cmap="Greys", norm="log")
+    ax.figure.colorbar(mesh, ax=ax, label="Points per bin")
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+
+    # Median MSD per lag for every source file
+    curve_of_row = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    file_of_row = curve_files[curve_of_row]
+    for i in range(len(unique_files)):
+        rows = positive & (file_of_row == i)
+        if rows.any():
+            medians = pd.Series(msds[rows]).groupby(intervals[rows]).median()
+            ax.plot(medians.index, medians.values, color=colors(i), linewidth=2)
+
+@_instrumented("plot_merged_msd")
+def plot_merged_msd(output_csv, output_file, x_limit=None, y_limit=None, mode="auto",
+                    density_threshold=DENSITY_CURVE_THRESHOLD):
+    # mode="lines" draws every curve, "density" a log-space histogram of all
+    # curves, and "auto" picks density above density_threshold curves
+    if mode not in MERGED_PLOT_MODES:
+        raise ValueError(f"Unknown plot mode: {mode} (choose from {', '.join(MERGED_PLOT_MODES)})")
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.lines import Line2D
+
+    # Read only the plotted columns of the merged MSD table
+    merged_df = read_msd_table(output_csv, columns=["source_file", "TRACK_ID", "interval", "msd"])
+
+    # Only the first 30 intervals are drawn; skip the per-track cut when the
+    # recorded lag limit shows the file holds nothing beyond them
+    max_lag_frames = read_msd_metadata(output_csv).get("max_lag_frames")
+    needs_cut = max_lag_frames is None or max_lag_frames > 30
+
+    unique_files, curve_files, offsets, intervals, msds = _group_merged_curves(merged_df, needs_cut)
+    del merged_df
+
+    # Number of curves (tracks) per source file
+    curves_per_file = np.bincount(curve_files, minlength=len(unique_files))
+    curve_count = int(curves_per_file.sum())
+    _count(rows=len(intervals), tracks=curve_count)
+    if mode == "auto":
+        mode = "density" if curve_count > density_threshold else "lines"
 
     # Initialize the figure
-    plt.figure(figsize=(12, 8))
+    fig = Figure(figsize=(12, 8))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
 
     # Define colors for different source files
-    unique_files = merged_df['source_file'].unique()
-    colors = plt.cm.get_cmap('tab20', len(unique_files))
-
-    # Initialize a counter for the number of curves plotted
-    curve_count = 0
-
-    # List to store legend entries
-    legend_labels = []
-
-    # Iterate over each source file
-    for i, file_name in enumerate(tqdm(unique_files, desc="Plotting MSD data")):
-        # Filter data for the current file
-        file_data = merged_df[merged_df['source_file'] == file_name]
+    import matplotlib.pyplot as plt
+    colors = plt.get_cmap('tab20', max(len(unique_files), 1))
 
-        # Get all unique track IDs
-        unique_track_ids = file_data["TRACK_ID"].unique()
-
-        # Plot MSD for each track ID
-        for track_id in unique_track_ids:
-            track_data = file_data[file_data["TRACK_ID"] == track_id].head(31)  # Select first 30 intervals
-            plt.plot(track_data["interval"], track_data["msd"], color=colors(i), alpha=0.7)
-
-            # Increment the curve count for each track
-            curve_count += 1
+    if mode == "density":
+        _draw_merged_density(ax, unique_files, curve_files, offsets, intervals, msds, colors, x_limit, y_limit)
+    else:
+        _draw_merged_lines(ax, unique_files, curve_files, offsets, intervals, msds, colors)
 
-        # Append an entry to the legend with the count of curves for this source file
-        legend_labels.append(f"{file_name} (Curves: {len(unique_track_ids)})")
+    # Legend entries with the count of curves for each source file
+    legend_handles = [Line2D([], [], color=colors(i), alpha=0.7) for i in range(len(unique_files))]
+    legend_labels = [f"{file_name} (Curves: {curves_per_file[i]})" for i, file_name in enumerate(unique_files)]
 
     # Add labels, title, and legend to the plot
-    plt.xlabel("Time Interval (s)")
-    plt.ylabel("MSD")
-    plt.title("Mean Squared Displacement (MSD) for All Tracks (First 30 Intervals)")
+    ax.set_xlabel("Time Interval (s)")
+    ax.set_ylabel("MSD")
+    ax.set_title("Mean Squared Displacement (MSD) for All Tracks (First 30 Intervals)")
 
-    # Set x and y limits if provided
+    # Set x and y limits if provided (a zero lower bound is kept at the data minimum on log axes)
     if x_limit is not None:
-        plt.xlim(x_limit)
+        ax.set_xlim(x_limit if mode == "lines" or x_limit[0] > 0 else (None, x_limit[1]))
         print(f"X-axis limits set to: {x_limit}")
     if y_limit is not None:
-        plt.ylim(y_limit)
+        ax.set_ylim(y_limit if mode == "lines" or y_limit[0] > 0 else (None, y_limit[1]))
         print(f"Y-axis limits set to: {y_limit}")
 
     # Display the legend with the curve counts included
-    plt.legend(legend_labels, loc="upper right", bbox_to_anchor=(1.05, 1), title="Source Files", fontsize=10)
+    ax.legend(legend_handles, legend_labels, loc="upper right", bbox_to_anchor=(1.05, 1), title="Source Files",
+              fontsize=10)
 
     # Save the combined plot to the specified output file
-    plt.savefig(output_file, dpi=300, bbox_inches="tight")  # Save with higher resolution and tight layout
-    plt.close()
+    fig.savefig(output_file, dpi=300, bbox_inches="tight")  # Save with higher resolution and tight layout
 
     # Print the total number of curves in the console
     print(f"Total number of curves plotted: {curve_count}")
 
 
+# Quantiles reported by the ensemble MSD statistics
+MSD_QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# File names of the ensemble statistics written next to each merged table
+ENSEMBLE_STATE_NAME = "ensemble_msd.npz"
+ENSEMBLE_SUMMARY_NAME = "ensemble_msd_summary.csv"
+ENSEMBLE_PLOT_NAME = "ensemble_msd_mean_sem.png"
+
+class EnsembleMSD:
+    # Per-lag statistics of MSD values across tracks, accumulated one table
+    # at a time. Count, mean and variance use Chan's parallel update; quantiles
+    # come from a fixed log10(MSD) histogram per lag. All parts merge by
+    # addition, so per-file or per-subfolder accumulators combine exactly
+    # without revisiting the rows.
+    HISTOGRAM_EDGES = np.linspace(-8.0, 8.0, 1281)  # log10(MSD), 1/80 decade bins
+
+    def __init__(self, time_interval=None):
+        self.time_interval = time_interval
+        self.count = np.zeros(0, dtype=np.int64)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        # Column 0 holds values below the first edge (including MSD 0), the last column those above
+        self.histogram = np.zeros((0, len(self.HISTOGRAM_EDGES) + 1), dtype=np.int64)
+
+    def _grow(self, n_lags):
+        extra = n_lags - len(self.count)
+        if extra > 0:
+            self.count = np.concatenate((self.count, np.zeros(extra, dtype=np.int64)))
+            self.mean = np.concatenate((self.mean, np.zeros(extra)))
+            self.m2 = np.concatenate((self.m2, np.zeros(extra)))
+            self.histogram = np.vstack((self.histogram, np.zeros((extra, self.histogram.shape[1]), dtype=np.int64)))
+
+    def _combine(self, count, mean, m2, histogram):
+        # Chan et al. pairwise update of count/mean/M2 for every lag at once
+        self._grow(len(count))
+        n_a = self.count[:len(count)].astype(float)
+        total = n_a + count
+        delta = mean - self.mean[:len(count)]
+        safe_total = np.where(total > 0, total, 1)
+        self.mean[:len(count)] += delta * count / safe_total
+        self.m2[:len(count)] += m2 + delta ** 2 * n_a * count / safe_total
+        self.count[:len(count)] += count.astype(np.int64)
+        self.histogram[:len(count)] += histogram
+
+    def _check_interval(self, time_interval):
+        if time_interval is None:
+            return
+        if self.time_interval is None:
+            self.time_interval = time_interval
+        elif not np.isclose(self.time_interval, time_interval):
+            raise ValueError(f"Cannot combine MSD statistics with time intervals {self.time_interval} "
+                             f"and {time_interval}")
+
+    def add(self, intervals, msds, time_interval):
+        # Add every (interval, msd) row of an MSD table; lag 0 is skipped
+        self._check_interval(time_interval)
+        intervals = np.asarray(intervals, dtype=float)
+        msds = np.asarray(msds, dtype=float)
+        # Rows without an interval (spot rows past the lag limit) are skipped
+        finite = np.isfinite(intervals) & np.isfinite(msds)
+        lags = np.rint(np.where(finite, intervals, 0.0) / time_interval).astype(np.int64)
+        valid = (lags > 0) & finite
+        lags, msds = lags[valid] - 1, msds[valid]
+        if len(lags) == 0:
+            return
+        n_lags = lags.max() + 1
+
+        count = np.bincount(lags, minlength=n_lags).astype(float)
+        mean = np.bincount(lags, weights=msds, minlength=n_lags) / np.maximum(count, 1)
+        m2 = np.bincount(lags, weights=(msds - mean[lags]) ** 2, minlength=n_lags)
+
+        bins = np.searchsorted(self.HISTOGRAM_EDGES, np.log10(np.maximum(msds, 1e-300)), side="right")
+        n_bins = self.histogram.shape[1]
+        histogram = np.bincount(lags * n_bins + bins, minlength=n_lags * n_bins).reshape(n_lags, n_bins)
+
+        self._combine(count, mean, m2, histogram)
+
+    def add_table(self, df, time_interval):
+        self.add(df["interval"].values, df["msd"].values, time_interval)
+
+    def merge(self, other):
+        self._check_interval(other.time_interval)
+        self._combine(other.count.astype(float), other.mean, other.m2, other.histogram)
+        return self
+
+    def _quantile(self, q):
+        # Linear interpolation in log10(MSD) inside the histogram bin holding quantile q
+        edges = self.HISTOGRAM_EDGES
+        cumulative = np.cumsum(self.histogram, axis=1)
+        target = q * self.count
+        values = np.full(len(self.count), np.nan)
+        for lag in np.flatnonzero(self.count):
+            bin_index = int(np.searchsorted(cumulative[lag], target[lag], side="left"))
+            if bin_index == 0:
+                values[lag] = 10 ** edges[0]
+            elif bin_index >= len(edges):
+                values[lag] = 10 ** edges[-1]
+            else:
+                below = cumulative[lag, bin_index - 1]
+                in_bin = self.histogram[lag, bin_index]
+                fraction = (target[lag] - below) / in_bin if in_bin else 0.0
+                values[lag] = 10 ** (edges[bin_index - 1] + fraction * (edges[bin_index] - edges[bin_index - 1]))
+        return values
+
+    def summary(self, quantiles=MSD_QUANTILES):
+        # One row per lag: count, mean, variance, SEM and approximate quantiles.
+        # n_below_range/n_above_range count MSDs outside the histogram (MSD 0
+        # included below); quantiles falling there are clipped to the edge.
+        lags = np.arange(1, len(self.count) + 1)
+        variance = np.where(self.count > 1, self.m2 / np.maximum(self.count - 1, 1), np.nan)
+        table = pd.DataFrame({
+            "lag": lags,
+            "interval": lags * (self.time_interval or np.nan),
+            "count": self.count,
+            "mean": np.where(self.count > 0, self.mean, np.nan),
+            "variance": variance,
+            "sem": np.sqrt(variance / np.maximum(self.count, 1)),
+        })
+        for q in quantiles:
+            table[f"q{int(round(q * 100)):02d}"] = self._quantile(q)
+        table["n_below_range"] = self.histogram[:, 0]
+        table["n_above_range"] = self.histogram[:, -1]
+        return table[table["count"] > 0].reset_index(drop=True)
+
+    def save(self, path):
+        np.savez_compressed(path, time_interval=np.nan if self.time_interval is None else self.time_interval,
+                            count=self.count, mean=self.mean, m2=self.m2, histogram=self.histogram,
+                            edges=self.HISTOGRAM_EDGES)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if not np.array_equal(data["edges"], cls.HISTOGRAM_EDGES):
+                raise ValueError(f"{path} was written with different histogram bins")
+            time_interval = float(data["time_interval"])
+            ensemble = cls(None if np.isnan(time_interval) else time_interval)
+            ensemble.count = data["count"]
+            ensemble.mean = data["mean"]
+            ensemble.m2 = data["m2"]
+            ensemble.histogram = data["histogram"]
+        return ensemble
+
+def _msd_time_interval(msd_file, df):
+    # Frame interval from the file metadata, else the smallest positive interval in the table
+    time_interval = read_msd_metadata(msd_file).get("time_interval")
+    if time_interval is None:
+        positive = df["interval"].values[df["interval"].values > 0]
+        time_interval = float(positive.min()) if len(positive) else None
+    return time_interval
+
+def write_ensemble_msd(ensemble, output_folder, prefix="ensemble_msd"):
+    # Save the mergeable state (.npz) and the per-lag summary table (.csv)
+    os.makedirs(output_folder, exist_ok=True)
+    ensemble.save(os.path.join(output_folder, prefix + ".npz"))
+    summary_csv = os.path.join(output_folder, prefix + "_summary.csv")
+    ensemble.summary().to_csv(summary_csv, index=False)
+    return summary_csv
+
+def plot_ensemble_msd(summary_csvs, output_file, labels=None, x_limit=None, y_limit=None):
+    # Mean MSD ± SEM per lag for one or more ensemble summary tables
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    if isinstance(summary_csvs, str):
+        summary_csvs = [summary_csvs]
+    labels = labels or [os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(path))))
+                        for path in summary_csvs]
+
+    fig = Figure(figsize=(8, 6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    for path, label in zip(summary_csvs, labels):
+        summary = pd.read_csv(path)
+        ax.errorbar(summary["interval"], summary["mean"], yerr=summary["sem"], capsize=2,
+                    label=f"{label} (max n: {summary['count'].max()})")
+
+    ax.set_xlabel("Time Interval (s)")
+    ax.set_ylabel("MSD")
+    ax.set_title("Ensemble-averaged MSD (mean ± SEM)")
+    if x_limit is not None:
+        ax.set_xlim(x_limit)
+    if y_limit is not None:
+        ax.set_ylim(y_limit)
+    ax.legend(fontsize=10)
+    fig.savefig(output_file, dpi=300, bbox_inches="tight")
+
+def combine_ensembles(base_dir, conditions=None):
+    # Combine the per-subfolder accumulators into per-condition results.
+    # `conditions` maps a condition name to its subfolders; by default every
+    # subfolder with an ensemble state is combined into one "all" condition.
+    # Displacement observables (msd_merge/merged_observables.npz) are
+    # combined the same way when present and not older than the subfolder's
+    # ensemble state, i.e. from the same merge. Outputs go to base_dir/msd_merge
+    # so they are never picked up as inputs.
+    if conditions is None:
+        conditions = {"all": sorted(os.listdir(base_dir))}
+
+    output_folder = os.path.join(base_dir, "msd_merge")
+    summary_csvs = []
+    for condition, subfolders in conditions.items():
+        ensemble = EnsembleMSD()
+        observables = None
+        used = 0
+        for subfolder in subfolders:
+            state = os.path.join(base_dir, subfolder, "msd_merge", ENSEMBLE_STATE_NAME)
+            if not os.path.exists(state):
+                continue
+            ensemble.merge(EnsembleMSD.load(state))
+            used += 1
+            observables_state = os.path.join(base_dir, subfolder, "msd_merge", "merged" + OBSERVABLES_STATE_SUFFIX)
+            if (os.path.exists(observables_state)
+                    and os.stat(observables_state).st_mtime_ns >= os.stat(state).st_mtime_ns):
+                loaded = DisplacementObservables.load(observables_state)
+                observables = loaded if observables is None else observables.merge(loaded)
+        if used == 0:
+            print(f"Error: No ensemble MSD statistics found for condition {condition}.")
+            continue
+        summary_csvs.append(write_ensemble_msd(ensemble, output_folder, f"ensemble_msd_{condition}"))
+        if observables is not None:
+            write_observables(observables, output_folder, f"ensemble_{condition}")
+        else:
+            remove_observables(output_folder, f"ensemble_{condition}")
+        print(f"Condition {condition}: combined {used} subfolders")
+    return summary_csvs
+
+# Suffix of the per-file observable state next to the MSD tables (a.csv -> a_observables.npz)
+OBSERVABLES_STATE_SUFFIX = "_observables.npz"
+
+class DisplacementObservables:
+    # Ensemble observables of the lagged displacements, accumulated one
+    # track table at a time by _msd_observables. Per lag: pair count and the
+    # sums of r^2 and r^4 (MSD and non-Gaussian parameter), the summed
+    # velocity products v(t).v(t+lag) (VACF), and, at van_hove_lags, a fixed
+    # histogram of the x and y displacements (self part of the van Hove
+    # function) with van_hove_bins bins over +-van_hove_range (in position
+    # units, so pixel exports need a wider range). Everything is a sum, so
+    # files and subfolders with the same lags and bins merge exactly.
+    def __init__(self, time_interval=None, observables=OBSERVABLES, van_hove_lags=VAN_HOVE_LAGS,
+                 vacf_lags=VACF_LAGS, van_hove_range=VAN_HOVE_RANGE, van_hove_bins=VAN_HOVE_BINS):
+        if not van_hove_range > 0 or int(van_hove_bins) < 1:
+            raise ValueError(f"The van Hove range must be positive and the bins at least 1, "
+                             f"got {van_hove_range} and {van_hove_bins}")
+        unknown = set(observables) - set(OBSERVABLES)
+        if unknown:
+            raise ValueError(f"Unknown observables: {', '.join(sorted(unknown))} "
+                             f"(choose from {', '.join(OBSERVABLES)})")
+        self.time_interval = time_interval
+        self.observables = tuple(name for name in OBSERVABLES if name in observables)
+        self.van_hove_lags = tuple(int(lag) for lag in van_hove_lags)
+        self.vacf_lags = int(vacf_lags)
+        self.van_hove_range = float(van_hove_range)
+        self.van_hove_bins = int(van_hove_bins)
+        self.van_hove_edges = np.linspace(-self.van_hove_range, self.van_hove_range, self.van_hove_bins + 1)
+        # Index = lag (entry 0 unused)
+        self.count = np.zeros(1, dtype=np.int64)
+        self.sum_r2 = np.zeros(1)
+        self.sum_r4 = np.zeros(1)
+        self.vacf_count = np.zeros(self.vacf_lags + 1, dtype=np.int64)
+        self.vacf_sum = np.zeros(self.vacf_lags + 1)
+        # Column 0 holds displacements below the first edge, the last column those above
+        self.van_hove = np.zeros((len(self.van_hove_lags), len(self.van_hove_edges) + 1), dtype=np.int64)
+
+    def _grow(self, n_lags):
+        extra = n_lags - len(self.count)
+        if extra > 0:
+            self.count = np.concatenate((self.count, np.zeros(extra, dtype=np.int64)))
+            self.sum_r2 = np.concatenate((self.sum_r2, np.zeros(extra)))
+            self.sum_r4 = np.concatenate((self.sum_r4, np.zeros(extra)))
+
+    def _check(self, other):
+        if (other.van_hove_lags, other.vacf_lags) != (self.van_hove_lags, self.vacf_lags):
+            raise ValueError("Cannot combine observables computed with different van Hove or VACF lags")
+        if (other.van_hove_range, other.van_hove_bins) != (self.van_hove_range, self.van_hove_bins):
+            raise ValueError(f"Cannot combine van Hove histograms with different bins ({self.van_hove_bins} over "
+                             f"+-{self.van_hove_range} and {other.van_hove_bins} over +-{other.van_hove_range})")
+        if other.time_interval is None:
+            return
+        if self.time_interval is None:
+            self.time_interval = other.time_interval
+        elif not np.isclose(self.time_interval, other.time_interval):
+            raise ValueError(f"Cannot combine observables with time intervals {self.time_interval} "
+                             f"and {other.time_interval}")
+
+    def add_displacements(self, lag, displacements):
+        # All (n, 2) displacements of one lag
+        self._grow(lag + 1)
+        r2 = np.sum(displacements ** 2, axis=1)
+        self.count[lag] += len(r2)
+        self.sum_r2[lag] += r2.sum()
+        self.sum_r4[lag] += np.sum(r2 ** 2)
+        if "van_hove" in self.observables and lag in self.van_hove_lags:
+            bins = np.searchsorted(self.van_hove_edges, displacements.ravel(), side="right")
+            self.van_hove[self.van_hove_lags.index(lag)] += np.bincount(bins, minlength=self.van_hove.shape[1])
+
+    def add_velocity_products(self, lag, products):
+        # Dot products of frame-to-frame displacements `lag` frames apart
+        self.vacf_count[lag] += len(products)
+        self.vacf_sum[lag] += products.sum()
+
+    def merge(self, other):
+        self._check(other)
+        self.observables = tuple(name for name in OBSERVABLES
+                                 if name in self.observables or name in other.observables)
+        self._grow(len(other.count))
+        self.count[:len(other.count)] += other.count
+        self.sum_r2[:len(other.count)] += other.sum_r2
+        self.sum_r4[:len(other.count)] += other.sum_r4
+        self.vacf_count += other.vacf_count
+        self.vacf_sum += other.vacf_sum
+        self.van_hove += other.van_hove
+        return self
+
+    def _interval(self, lags):
+        return lags * (self.time_interval or np.nan)
+
+    def vacf_table(self):
+        # <v(t).v(t+lag)> with v in displacement units per second, and normalized by lag 0
+        lags = np.arange(self.vacf_lags + 1)
+        dt = self.time_interval or 1.0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            vacf = self.vacf_sum / self.vacf_count / dt ** 2
+        table = pd.DataFrame({"lag": lags, "interval": self._interval(lags), "count": self.vacf_count,
+                              "vacf": vacf, "vacf_normalized": vacf / vacf[0]})
+        return table[table["count"] > 0].reset_index(drop=True)
+
+    def ngp_table(self):
+        # 2D non-Gaussian parameter alpha2 = <r^4> / (2 <r^2>^2) - 1 (0 for Brownian motion)
+        lags = np.arange(len(self.count))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            msd = self.sum_r2 / self.count
+            msd4 = self.sum_r4 / self.count
+            ngp = msd4 / (2 * msd ** 2) - 1
+        table = pd.DataFrame({"lag": lags, "interval": self._interval(lags), "count": self.count,
+                              "msd": msd, "msd4": msd4, "ngp": ngp})
+        return table[table["count"] > 0].reset_index(drop=True)
+
+    def van_hove_table(self):
+        # Long format, one row per lag and bin (first/last rows: outside the edges).
+        # density is normalized over all displacements of the lag, per unit length.
+        edges = self.van_hove_edges
+        left = np.concatenate(([-np.inf], edges))
+        right = np.concatenate((edges, [np.inf]))
+        lags = np.repeat(self.van_hove_lags, len(left))
+        counts = self.van_hove.ravel()
+        totals = np.repeat(self.van_hove.sum(axis=1), len(left))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            density = counts / totals / np.tile(right - left, len(self.van_hove_lags))
+        return pd.DataFrame({"lag": lags, "interval": self._interval(lags),
+                             "bin_left": np.tile(left, len(self.van_hove_lags)),
+                             "bin_right": np.tile(right, len(self.van_hove_lags)),
+                             "count": counts, "density": np.where(np.isfinite(density), density, np.nan)})
+
+    def tables(self):
+        # {observable: table} for the requested observables
+        builders = {"vacf": self.vacf_table, "van_hove": self.van_hove_table, "ngp": self.ngp_table}
+        return {name: builders[name]() for name in self.observables}
+
+    def save(self, path):
+        np.savez_compressed(path, time_interval=np.nan if self.time_interval is None else self.time_interval,
+                            observables=np.array(self.observables), van_hove_lags=np.array(self.van_hove_lags),
+                            vacf_lags=self.vacf_lags, count=self.count, sum_r2=self.sum_r2, sum_r4=self.sum_r4,
+                            vacf_count=self.vacf_count, vacf_sum=self.vacf_sum, van_hove=self.van_hove,
+                            van_hove_range=self.van_hove_range, van_hove_bins=self.van_hove_bins)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if "van_hove_range" not in data.files:
+                raise ValueError(f"{path} was written without its van Hove bins; rerun the msd stage")
+            time_interval = float(data["time_interval"])
+            accumulator = cls(None if np.isnan(time_interval) else time_interval, tuple(data["observables"]),
+                              tuple(data["van_hove_lags"]), int(data["vacf_lags"]), float(data["van_hove_range"]),
+                              int(data["van_hove_bins"]))
+            if data["van_hove"].shape != accumulator.van_hove.shape:
+                raise ValueError(f"{path} has van Hove histograms that don't match its bins")
+            for name in ("count", "sum_r2", "sum_r4", "vacf_count", "vacf_sum", "van_hove"):
+                setattr(accumulator, name, data[name])
+        return accumulator
+
+def remove_observables(output_folder, prefix):
+    # Delete the state and tables write_observables may have left for this prefix
+    paths = [os.path.join(output_folder, prefix + OBSERVABLES_STATE_SUFFIX)]
+    paths += [os.path.join(output_folder, f"{prefix}_{name}" + extension)
+              for name in OBSERVABLES for extension in TABLE_FORMATS.values()]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+def write_observables(accumulator, output_folder, prefix, output_format="csv"):
+    # Mergeable state (<prefix>_observables.npz) plus one table per observable
+    # (<prefix>_vacf.csv, <prefix>_van_hove.csv, <prefix>_ngp.csv); outputs of
+    # an earlier run with other observables or another format are removed
+    os.makedirs(output_folder, exist_ok=True)
+    remove_observables(output_folder, prefix)
+    accumulator.save(os.path.join(output_folder, prefix + OBSERVABLES_STATE_SUFFIX))
+    tables = []
+    for name, table in accumulator.tables().items():
+        path = os.path.join(output_folder, f"{prefix}_{name}" + TABLE_FORMATS[output_format])
+        write_msd_table(table, path)
+        tables.append(path)
+    return tables
+
+def merge_observables(msd_csv_folder, output_folder, output_format="csv", prefix="merged"):
+    # Combine the per-file observable states of one msd_csv folder; None (and
+    # earlier merged outputs removed) if there are none
+    states = sorted(os.path.join(msd_csv_folder, name) for name in os.listdir(msd_csv_folder)
+                    if name.endswith(OBSERVABLES_STATE_SUFFIX))
+    if not states:
+        remove_observables(output_folder, prefix)
+        return None
+    accumulator = DisplacementObservables.load(states[0])
+    for path in states[1:]:
+        accumulator.merge(DisplacementObservables.load(path))
+    return write_observables(accumulator, output_folder, prefix, output_format)
+
+# Default fit window (lags 1..FIT_LAGS) for the per-track D/alpha fits
+FIT_LAGS = 10
+
+FIT_COLUMNS = ["TRACK_ID", "source_file", "D", "alpha", "R2", "n_points", "D_linear", "offset_linear", "R2_linear"]
+
+def _grouped_line_fits(groups, x, y, n_groups):
+    # Least-squares y = slope * x + intercept for every group at once from
+    # per-group sums (ragged input, no padding); groups with < 2 points get NaN
+    n = np.bincount(groups, minlength=n_groups).astype(float)
+    sx = np.bincount(groups, weights=x, minlength=n_groups)
+    sy = np.bincount(groups, weights=y, minlength=n_groups)
+    sxx = np.bincount(groups, weights=x * x, minlength=n_groups)
+    sxy = np.bincount(groups, weights=x * y, minlength=n_groups)
+    syy = np.bincount(groups, weights=y * y, minlength=n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_x = n * sxx - sx ** 2
+        var_y = n * syy - sy ** 2
+        cov = n * sxy - sx * sy
+        slope = np.where(n >= 2, cov / var_x, np.nan)
+        intercept = np.where(n >= 2, (sy - slope * sx) / n, np.nan)
+        # Perfectly flat data (var_y == 0) is fitted exactly
+        r2 = np.where(n >= 2, np.where(var_y > 0, cov ** 2 / (var_x * var_y), 1.0), np.nan)
+    return slope, intercept, r2, n.astype(np.int64)
+
+def fit_msd_table(df, time_interval, fit_lags=FIT_LAGS, min_length=None):
+    # Fit MSD = 4 D t^alpha to every track of an MSD table over lags
+    # 1..fit_lags: log-log (D, alpha, R2) and linear with an offset for
+    # localization error (D_linear, alpha fixed at 1). Tracks with fewer than
+    # min_length frames (default fit_lags + 1, a full window) are dropped;
+    # frames are counted from the table, so tracks longer than max_lag + 1
+    # all count as max_lag + 1.
+    if min_length is None:
+        min_length = fit_lags + 1
+    track_ids, groups, frames = np.unique(df["TRACK_ID"].values, return_inverse=True, return_counts=True)
+    t = df["interval"].values.astype(float)
+    msd = df["msd"].values.astype(float)
+    finite = np.isfinite(t) & np.isfinite(msd)
+    lags = np.rint(np.where(finite, t, 0.0) / time_interval).astype(np.int64)
+
+    window = (lags >= 1) & (lags <= fit_lags) & finite
+    slope, offset, r2_linear, _ = _grouped_line_fits(groups[window], t[window], msd[window], len(track_ids))
+
+    positive = window & (msd > 0)
+    alpha, log_4d, r2, n_points = _grouped_line_fits(groups[positive], np.log(t[positive]),
+                                                     np.log(msd[positive]), len(track_ids))
+
+    fits = pd.DataFrame({
+        "TRACK_ID": track_ids,
+        "D": np.exp(log_4d) / 4,
+        "alpha": alpha,
+        "R2": r2,
+        "n_points": n_points,
+        "D_linear": slope / 4,
+        "offset_linear": offset,
+        "R2_linear": r2_linear,
+    })
+    return fits[frames >= min_length].reset_index(drop=True)
+
+@_instrumented("fit_msd_tables")
+def fit_msd_tables(msd_files, output_file, fit_lags=FIT_LAGS, min_length=None, time_interval=None):
+    # Fit every track of every MSD table into one per-track table; the frame
+    # interval comes from each file's metadata unless given
+    fits = []
+    for file_path in tqdm(msd_files, desc="Fitting MSD curves"):
+        df = read_msd_table(file_path, columns=["TRACK_ID", "interval", "msd"])
+        interval = time_interval or _msd_time_interval(file_path, df)
+        if interval is None:
+            print(f"Error: No time interval known for {file_path}; skipping.")
+            continue
+        file_fits = fit_msd_table(df, interval, fit_lags, min_length)
+        file_fits.insert(1, "source_file", os.path.basename(file_path))
+        fits.append(file_fits)
+
+    fits = pd.concat(fits, ignore_index=True) if fits else pd.DataFrame(columns=FIT_COLUMNS)
+    _count(rows=len(fits), tracks=len(fits))
+    write_msd_table(fits[FIT_COLUMNS], output_file)
+    write_msd_metadata(output_file, {"fit_lags": fit_lags,
+                                     "min_length": fit_lags + 1 if min_length is None else min_length,
+                                     "source_files": [os.path.basename(path) for path in msd_files]})
+    print(f"Per-track fits saved as {output_file}")
+    return fits
+
+def fit_subfolders(base_dir, fit_lags=FIT_LAGS, min_length=None, output_format="csv"):
+    # One per-track fit table per subfolder, next to the merged MSD table
+    outputs = []
+    for subfolder in sorted(os.listdir(base_dir)):
+        msd_csv_path = os.path.join(base_dir, subfolder, "msd_csv")
+        if not os.path.isdir(msd_csv_path):
+            continue
+        msd_files = find_all_msd_csv(msd_csv_path, output_format)
+        if not msd_files:
+            print(f"Error: No MSD CSV files found in the subfolder {msd_csv_path}.")
+            continue
+        msd_merge_path = os.path.join(base_dir, subfolder, "msd_merge")
+        os.makedirs(msd_merge_path, exist_ok=True)
+        output_file = os.path.join(msd_merge_path, "msd_fits" + TABLE_FORMATS[output_format])
+        fit_msd_tables(msd_files, output_file, fit_lags, min_length)
+        outputs.append(output_file)
+    return outputs
+
+# Default number of resamples and seed of the resampling statistics
+RESAMPLES = 10000
+RESAMPLING_SEED = 0
+
+# Elements (resamples x values) drawn per batch, bounding the memory of the resampling
+RESAMPLING_CHUNK = 1 << 22
+
+RESAMPLING_STATISTICS = {"mean": np.mean, "median": np.median}
+
+def _subfolder_track_metrics(subfolder_path, output_format="csv", fit_lags=FIT_LAGS, min_length=None):
+    # Per-track D/alpha of a subfolder: the fit stage's table if it exists,
+    # else fitted from the merged MSD table
+    msd_merge_path = os.path.join(subfolder_path, "msd_merge")
+    fits_file = os.path.join(msd_merge_path, "msd_fits" + TABLE_FORMATS[output_format])
+    if os.path.exists(fits_file):
+        return read_msd_table(fits_file)
+
+    merged_file = os.path.join(msd_merge_path, "merged_msd_data" + TABLE_FORMATS[output_format])
+    if not os.path.exists(merged_file):
+        return None
+    merged = read_msd_table(merged_file, columns=["source_file", "TRACK_ID", "interval", "msd"])
+    time_interval = read_msd_metadata(merged_file).get("time_interval") or _msd_time_interval(merged_file, merged)
+    fits = []
+    for source_file, df in merged.groupby("source_file", sort=False):
+        file_fits = fit_msd_table(df, time_interval, fit_lags, min_length)
+        file_fits.insert(1, "source_file", source_file)
+        fits.append(file_fits)
+    return pd.concat(fits, ignore_index=True) if fits else None
+
+def _bootstrap(values, statistic, n_resamples, rng):
+    # Bootstrap distribution of the statistic, drawn in batches of resamples
+    estimates = np.empty(n_resamples)
+    per_batch = max(1, RESAMPLING_CHUNK // max(len(values), 1))
+    for start in range(0, n_resamples, per_batch):
+        k = min(per_batch, n_resamples - start)
+        estimates[start:start + k] = statistic(values[rng.integers(0, len(values), size=(k, len(values)))], axis=1)
+    return estimates
+
+def _permutation_p_value(a, b, statistic, n_resamples, rng):
+    # Two-sided permutation test of statistic(a) - statistic(b); every batch
+    # permutes many copies of the pooled values at once
+    pooled = np.concatenate((a, b))
+    observed = statistic(a) - statistic(b)
+    per_batch = max(1, RESAMPLING_CHUNK // len(pooled))
+    extreme = 0
+    for start in range(0, n_resamples, per_batch):
+        k = min(per_batch, n_resamples - start)
+        permuted = rng.permuted(np.tile(pooled, (k, 1)), axis=1)
+        differences = statistic(permuted[:, :len(a)], axis=1) - statistic(permuted[:, len(a):], axis=1)
+        extreme += int(np.sum(np.abs(differences) >= np.abs(observed) * (1 - 1e-12)))
+    return observed, (extreme + 1) / (n_resamples + 1)
+
+def _holm(p_values):
+    p_values = np.asarray(p_values, dtype=float)
+    order = np.argsort(p_values)
+    adjusted = np.maximum.accumulate((len(p_values) - np.arange(len(p_values))) * p_values[order])
+    result = np.empty(len(p_values))
+    result[order] = np.minimum(adjusted, 1.0)
+    return result
+
+def _p_label(p):
+    # Same labels as Statistical analysis.R
+    return "(***)" if p < 0.001 else "(**)" if p < 0.01 else "(*)" if p < 0.05 else "(ns)"
+
+@_instrumented("resampling_stats")
+def resampling_stats(base_dir, conditions=None, metrics=("D", "alpha"), n_resamples=RESAMPLES,
+                     seed=RESAMPLING_SEED, confidence=0.95, statistic="mean", output_format="csv"):
+    # Bootstrap CIs per condition and pairwise permutation tests between
+    # conditions for per-track metrics. `conditions` maps names to subfolders
+    # (default: one condition per subfolder). Every test draws from its own
+    # generator seeded with (seed, test index), so results are reproducible.
+    # Writes base_dir/msd_merge/resampling_stats.csv (tidy) and one wide CSV
+    # per metric in base_dir/msd_merge/r_input/ for Statistical analysis.R.
+    if statistic not in RESAMPLING_STATISTICS:
+        raise ValueError(f"Unknown statistic: {statistic} (choose from {', '.join(RESAMPLING_STATISTICS)})")
+    stat = RESAMPLING_STATISTICS[statistic]
+    if conditions is None:
+        conditions = {subfolder: [subfolder] for subfolder in sorted(os.listdir(base_dir))
+                      if os.path.isdir(os.path.join(base_dir, subfolder, "msd_merge"))}
+
+    values = {}
+    for condition, subfolders in conditions.items():
+        tables = [_subfolder_track_metrics(os.path.join(base_dir, subfolder), output_format) for subfolder in subfolders]
+        tables = [table for table in tables if table is not None and len(table)]
+        if not tables:
+            print(f"Error: No per-track metrics found for condition {condition}.")
+            continue
+        values[condition] = pd.concat(tables, ignore_index=True)
+        _count(tracks=len(values[condition]))
+
+    output_folder = os.path.join(base_dir, "msd_merge")
+    wide_folder = os.path.join(output_folder, "r_input")
+    os.makedirs(wide_folder, exist_ok=True)
+    names = list(values)
+    rows = []
+    test_index = 0
+    for metric in metrics:
+        samples = {name: values[name][metric].dropna().values.astype(float) for name in names}
+        samples = {name: sample[np.isfinite(sample)] for name, sample in samples.items() if len(sample)}
+
+        for name, sample in samples.items():
+            estimates = _bootstrap(sample, stat, n_resamples, np.random.default_rng([seed, test_index]))
+            test_index += 1
+            low, high = np.quantile(estimates, [(1 - confidence) / 2, (1 + confidence) / 2])
+            rows.append({"metric": metric, "test": "bootstrap", "group1": name, "group2": None,
+                         "n1": len(sample), "n2": None, "statistic": statistic, "estimate": stat(sample),
+                         "ci_low": low, "ci_high": high, "p_value": None})
+
+        first_test = len(rows)
+        for name_a, name_b in itertools.combinations(samples, 2):
+            observed, p_value = _permutation_p_value(samples[name_a], samples[name_b], stat, n_resamples,
+                                                     np.random.default_rng([seed, test_index]))
+            test_index += 1
+            rows.append({"metric": metric, "test": "permutation", "group1": name_a, "group2": name_b,
+                         "n1": len(samples[name_a]), "n2": len(samples[name_b]), "statistic": statistic,
+                         "estimate": observed, "ci_low": None, "ci_high": None, "p_value": p_value})
+        if len(rows) > first_test:
+            adjusted = _holm([row["p_value"] for row in rows[first_test:]])
+            for row, p_adj in zip(rows[first_test:], adjusted):
+                row["p_adj"] = p_adj
+                row["p_label"] = _p_label(p_adj)
+
+        # Wide layout of the R script: an ID column ("mouse") and one column per group
+        wide = pd.DataFrame({name: pd.Series(sample) for name, sample in samples.items()})
+        wide.insert(0, "mouse", np.arange(1, len(wide) + 1))
+        wide.to_csv(os.path.join(wide_folder, f"{metric}_wide.csv"), index=False)
+
+    columns = ["metric", "test", "group1", "group2", "n1", "n2", "statistic", "estimate", "ci_low", "ci_high",
+               "p_value", "p_adj", "p_label"]
+    results = pd.DataFrame(rows, columns=columns).astype({"n1": "Int64", "n2": "Int64"})
+    results["n_resamples"] = n_resamples
+    results["seed"] = seed
+    results_csv = os.path.join(output_folder, "resampling_stats.csv")
+    results.to_csv(results_csv, index=False)
+    print(f"Resampling statistics saved as {results_csv}")
+    return results
+
+def _merge_fingerprint(msd_files, x_limit=None, y_limit=None):
+    # Size/mtime of every table feeding a stage, plus the plot limits. MSD
+    # files are only rewritten by make_msd_csv and merged tables by the merge
+    # stage, so this changes exactly when an input was rewritten, added or removed.
+    files = {}
+    for path in sorted(msd_files):
+        stat = os.stat(path)
+        files[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    return {"files": files, "x_limit": list(x_limit) if x_limit else None,
+            "y_limit": list(y_limit) if y_limit else None}
+
+@_instrumented("process_subfolders")
+def process_subfolders(base_dir, x_limit=None, y_limit=None, incremental=False, output_format="csv",
+                       merge=True, plot=True):
+    # merge/plot select the stages to run. With incremental=True each stage is
+    # skipped for subfolders whose inputs match the manifest and whose outputs
+    # still exist: the merge when the MSD files are unchanged ("merges"), the
+    # plots when the merged table and limits are unchanged ("plots").
+    manifest = load_manifest(base_dir) if incremental else None
 
-def process_subfolders(base_dir, x_limit=None, y_limit=None):
     # Iterate through each subfolder in the base directory
-    for subfolder in os.listdir(base_dir):
+    for subfolder in sorted(os.listdir(base_dir)):
         subfolder_path = os.path.join(base_dir, subfolder)
         msd_csv_path = os.path.join(subfolder_path, "msd_csv")
         msd_merge_path = os.path.join(subfolder_path, "msd_merge")
 
         if os.path.isdir(subfolder_path) and os.path.isdir(msd_csv_path):
-            print(f"Processing subfolder: {subfolder_path}")
-
-            # Create the msd_merge subfolder if it doesn't exist
-            os.makedirs(msd_merge_path, exist_ok=True)
-
             # Define paths for the merged CSV and output plot
-            merged_csv = os.path.join(msd_merge_path, "merged_msd_data.csv")
+            merged_csv = os.path.join(msd_merge_path, "merged_msd_data" + TABLE_FORMATS[output_format])
             output_file = os.path.join(msd_merge_path, "all_tracks_msd_first_30_intervals.png")
 
-            # Merge MSD CSV files in the msd_csv subfolder
-            merge_msd_csvs(msd_csv_path, merged_csv)
-
-            # Plot the merged MSD data
-            plot_merged_msd(merged_csv, output_file, x_limit, y_limit)
-
-# Example usage:
-base_dir = "/your/data/"  # Update this path as needed
-x_limit = (0,6)  # Example x-axis limit
-y_limit = (0,0.5)# Example y-axis limit
-
-# Process each subfolder in the base directory with specified limits
-process_subfolders(base_dir, x_limit, y_limit)
-
-#print(merged_df.head())
-
-"""### plotting"""
-
-def find_all_msd_csv(subfolder):
-    # Initialize a list to store paths of CSV files
-    msd_files = []
-
-    # Walk through the subfolder
-    for root, dirs, files in os.walk(subfolder):
-        for file in files:
-            if 'msd' in file and file.endswith('.csv'):
-                msd_files.append(os.path.join(root, file))
-
-    return msd_files
-
-def merge_msd_csvs(subfolder, output_csv):
-    # Find all MSD CSV files in the specified subfolder
-    msd_files = find_all_msd_csv(subfolder)
-
-    # If no MSD CSV files are found, print an error message and return
-    if not msd_files:
-        print(f"Error: No MSD CSV files found in the subfolder {subfolder}.")
-        return
-
-    # Initialize an empty DataFrame to hold all MSD data
-    merged_df = pd.DataFrame()
-
-    # Iterate over each MSD file with progress bar
-    for file_path in tqdm(msd_files, desc=f"Merging MSD files in {subfolder}"):
-        # Read the MSD data from the CSV file
-        df = pd.read_csv(file_path)
-        # Add a column to identify the source file
-        df['source_file'] = os.path.basename(file_path)
-        # Append the data to the merged DataFrame
-        merged_df = pd.concat([merged_df, df], ignore_index=True)
-
-    # Save the merged DataFrame to a CSV file
-    merged_df.to_csv(output_csv, index=False)
-    print(f"Merged CSV saved as {output_csv}")
-
-def plot_merged_msd(output_csv, output_file, x_limit=None, y_limit=None):
-    # Read the merged MSD data from the CSV file
-    merged_df = pd.read_csv(output_csv)
-
-    # Initialize the figure
-    plt.figure(figsize=(12, 8))
-
-    # Define colors for different source files
-    unique_files = merged_df['source_file'].unique()
-    colors = plt.cm.get_cmap('tab20', len(unique_files))
-
-    # Initialize a counter for the number of curves plotted
-    curve_count = 0
-
-    # List to store legend entries
-    legend_labels = []
-
-    # Iterate over each source file
-    for i, file_name in enumerate(tqdm(unique_files, desc="Plotting MSD data")):
-        # Filter data for the current file
-        file_data = merged_df[merged_df['source_file'] == file_name]
-
-        # Get all unique track IDs
-        unique_track_ids = file_data["TRACK_ID"].unique()
-
-        # Plot MSD for each track ID
-        for track_id in unique_track_ids:
-            track_data = file_data[file_data["TRACK_ID"] == track_id].head(31)  # Select first 30 intervals
-            plt.plot(track_data["interval"], track_data["msd"], color=colors(i), alpha=0.7)
-
-            # Increment the curve count for each track
-            curve_count += 1
-
-        # Append an entry to the legend with the count of curves for this source file
-        legend_labels.append(f"{file_name} (Curves: {len(unique_track_ids)})")
-
-    # Add labels, title, and legend to the plot
-    plt.xlabel("Time Interval (s)")
-    plt.ylabel("MSD")
-    plt.title("Mean Squared Displacement (MSD) for All Tracks (First 30 Intervals)")
-
-    # Set x and y limits if provided
-    if x_limit is not None:
-        plt.xlim(x_limit)
-        print(f"X-axis limits set to: {x_limit}")
-    if y_limit is not None:
-        plt.ylim(y_limit)
-        print(f"Y-axis limits set to: {y_limit}")
-
-    # Display the legend with the curve counts included
-    plt.legend(legend_labels, loc="upper right", bbox_to_anchor=(1.05, 1), title="Source Files", fontsize=10)
-
-    # Save the combined plot to the specified output file
-    plt.savefig(output_file, dpi=300, bbox_inches="tight")  # Save with higher resolution and tight layout
-    plt.close()
-
-    # Print the total number of curves in the console
-    print(f"Total number of curves plotted: {curve_count}")
-
-
-
-def process_subfolders(base_dir, x_limit=None, y_limit=None):
-    # Iterate through each subfolder in the base directory
-    for subfolder in os.listdir(base_dir):
-        subfolder_path = os.path.join(base_dir, subfolder)
-        msd_csv_path = os.path.join(subfolder_path, "msd_csv")
-        msd_merge_path = os.path.join(subfolder_path, "msd_merge")
-
-        if os.path.isdir(subfolder_path) and os.path.isdir(msd_csv_path):
             print(f"Processing subfolder: {subfolder_path}")
 
             # Create the msd_merge subfolder if it doesn't exist
             os.makedirs(msd_merge_path, exist_ok=True)
 
-            # Define paths for the merged CSV and output plot
-            merged_csv = os.path.join(msd_merge_path, "merged_msd_data.csv")
-            output_file = os.path.join(msd_merge_path, "all_tracks_msd_first_30_intervals.png")
-
             # Merge MSD CSV files in the msd_csv subfolder
-            merge_msd_csvs(msd_csv_path, merged_csv)
+            if merge:
+                fingerprint = _merge_fingerprint(find_all_msd_csv(msd_csv_path, output_format))
+                if (incremental and manifest["merges"].get(subfolder) == fingerprint
+                        and os.path.exists(merged_csv)):
+                    print(f"Skipping unchanged merge: {subfolder_path}")
+                else:
+                    merge_msd_csvs(msd_csv_path, merged_csv, output_format=output_format)
+                    merge_observables(msd_csv_path, msd_merge_path, output_format)
+                    if incremental and os.path.exists(merged_csv):
+                        manifest["merges"][subfolder] = fingerprint
+                        save_manifest(base_dir, manifest)
 
             # Plot the merged MSD data
-            plot_merged_msd(merged_csv, output_file, x_limit, y_limit)
-
-# Example usage:
-base_dir = "/Users/yourname/data"  # Update this path as needed
-x_limit = (0,6)  # Example x-axis limit
-y_limit = (0,0.5)# Example y-axis limit
-
-# Process each subfolder in the base directory with specified limits
-process_subfolders(base_dir, x_limit, y_limit)
-
-#print(merged_df.head())
\ No newline at end of file
+            if plot:
+                if not os.path.exists(merged_csv):
+                    print(f"Error: No merged MSD table {merged_csv}; run the merge stage first.")
+                    continue
+                fingerprint = _merge_fingerprint([merged_csv], x_limit, y_limit)
+                if (incremental and manifest["plots"].get(subfolder) == fingerprint
+                        and os.path.exists(output_file)):
+                    print(f"Skipping unchanged plots: {subfolder_path}")
+                    continue
+                plot_merged_msd(merged_csv, output_file, x_limit, y_limit)
+                ensemble_summary = os.path.join(msd_merge_path, ENSEMBLE_SUMMARY_NAME)
+                if os.path.exists(ensemble_summary):
+                    plot_ensemble_msd(ensemble_summary, os.path.join(msd_merge_path, ENSEMBLE_PLOT_NAME),
+                                      [subfolder], x_limit, y_limit)
+                if incremental:
+                    manifest["plots"][subfolder] = fingerprint
+                    save_manifest(base_dir, manifest)
+
+def _parse_max_lag(value):
+    # "30" -> 30 lags, "0.25" -> a quarter of each track, "none" -> all lags
+    if value.lower() == "none":
+        return None
+    return float(value) if "." in value else int(value)
+
+def _parse_state_threshold(value):
+    # "alpha=0.6" -> ("alpha", 0.6)
+    feature, _, threshold = value.partition("=")
+    if feature not in LOCAL_STATE_FEATURES or not threshold:
+        raise ValueError(f"Expected FEATURE=VALUE with FEATURE in {', '.join(LOCAL_STATE_FEATURES)}, got {value}")
+    return feature, float(threshold)
+
+def _parse_conditions(specs):
+    # ["WT=wt1,wt2", "KO=ko1"] -> {"WT": ["wt1", "wt2"], "KO": ["ko1"]}; None if no specs
+    if not specs:
+        return None
+    conditions = {}
+    for spec in specs:
+        name, _, subfolders = spec.partition("=")
+        conditions[name] = [s for s in subfolders.split(",") if s]
+    return conditions
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="MSD analysis of TrackMate track exports.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(sub):
+        sub.add_argument("base_dir", help="Directory with one subfolder per condition")
+        sub.add_argument("--format", dest="output_format", choices=list(TABLE_FORMATS), default="csv",
+                         help="Table format of MSD and merged outputs (parquet/feather need pyarrow)")
+        sub.add_argument("--incremental", action="store_true",
+                         help="Skip inputs and merges unchanged since the last run (msd_manifest.json)")
+        sub.add_argument("--report", default=None,
+                         help="Write per-stage timing/memory report to this .json or .csv file")
+
+    def add_msd_options(sub):
+        sub.add_argument("--time-interval", type=float, default=0.2, help="Frame interval in seconds")
+        sub.add_argument("--max-lag", type=_parse_max_lag, default=None,
+                         help="Lags per track (int), fraction of track length (float) or 'none' (default: all)")
+        sub.add_argument("--method", choices=MSD_METHODS, default="frames",
+                         help="MSD engine (frames: lags from POSITION_T, handles skipped frames)")
+        sub.add_argument("--chunksize", type=int, default=None,
+                         help="Stream exports in chunks of this many rows")
+        sub.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+        sub.add_argument("--plot-layout", choices=list(PLOT_LAYOUTS) + ["none"], default="png",
+                         help="Per-track plots: png per track, contact sheets, one pdf, or none")
+        sub.add_argument("--local-window", type=int, default=None, metavar="FRAMES",
+                         help="Add per-frame local_D/local_alpha from a rolling-window MSD of this many frames")
+        sub.add_argument("--local-lags", type=int, default=LOCAL_LAGS, help="Lags of the local MSD fit")
+        sub.add_argument("--state-threshold", type=_parse_state_threshold, default=None, metavar="FEATURE=VALUE",
+                         help="Segment frames into states by local alpha or D, e.g. alpha=0.6")
+        sub.add_argument("--observables", nargs="+", choices=OBSERVABLES, default=None,
+                         help="Also derive these from the MSD displacements (frames method)")
+        sub.add_argument("--van-hove-lags", type=int, nargs="+", default=list(VAN_HOVE_LAGS),
+                         help="Lags of the van Hove displacement histograms")
+        sub.add_argument("--van-hove-range", type=float, default=VAN_HOVE_RANGE, metavar="MAX",
+                         help="Van Hove histograms cover displacements -MAX..MAX per axis (position units)")
+        sub.add_argument("--van-hove-bins", type=int, default=VAN_HOVE_BINS, help="Bins of the van Hove histograms")
+        sub.add_argument("--vacf-lags", type=int, default=VACF_LAGS, help="VACF over lags 0..N")
+        sub.add_argument("--profile", default=None, metavar="CSV",
+                         help="Run this input file under cProfile (dump saved as <input>.prof)")
+
+    def add_plot_options(sub):
+        sub.add_argument("--x-limit", type=float, nargs=2, default=None, metavar=("MIN", "MAX"))
+        sub.add_argument("--y-limit", type=float, nargs=2, default=None, metavar=("MIN", "MAX"))
+
+    msd_parser = subparsers.add_parser("msd", help="Compute per-file MSD tables (and per-track plots)")
+    add_common(msd_parser)
+    add_msd_options(msd_parser)
+
+    merge_parser = subparsers.add_parser("merge", help="Merge MSD tables per subfolder")
+    add_common(merge_parser)
+
+    plot_parser = subparsers.add_parser("plot", help="Plot the merged MSD table of each subfolder")
+    add_common(plot_parser)
+    add_plot_options(plot_parser)
+
+    def add_fit_options(sub):
+        sub.add_argument("--fit-lags", type=int, default=FIT_LAGS, help="Fit MSD over lags 1..N")
+        sub.add_argument("--min-length", type=int, default=None,
+                         help="Minimum frames per fitted track (default: fit lags + 1)")
+
+    fit_parser = subparsers.add_parser("fit", help="Fit D and alpha to every track of each subfolder")
+    add_common(fit_parser)
+    add_fit_options(fit_parser)
+
+    ensemble_parser = subparsers.add_parser(
+        "ensemble", help="Combine per-subfolder ensemble MSD statistics into per-condition results")
+    ensemble_parser.add_argument("base_dir", help="Directory with one subfolder per condition")
+    ensemble_parser.add_argument("--condition", action="append", default=[], metavar="NAME=SUB1,SUB2",
+                                 help="Group subfolders into a condition (repeatable; default: all subfolders)")
+    add_plot_options(ensemble_parser)
+
+    stats_parser = subparsers.add_parser(
+        "stats", help="Bootstrap CIs and permutation tests of per-track D/alpha between conditions")
+    stats_parser.add_argument("base_dir", help="Directory with one subfolder per condition")
+    stats_parser.add_argument("--format", dest="output_format", choices=list(TABLE_FORMATS), default="csv",
+                              help="Table format of the merged/fit tables to read")
+    stats_parser.add_argument("--condition", action="append", default=[], metavar="NAME=SUB1,SUB2",
+                              help="Group subfolders into a condition (repeatable; default: one per subfolder)")
+    stats_parser.add_argument("--metric", nargs="+", default=["D", "alpha"], help="Per-track columns to test")
+    stats_parser.add_argument("--statistic", choices=list(RESAMPLING_STATISTICS), default="mean")
+    stats_parser.add_argument("--resamples", type=int, default=RESAMPLES)
+    stats_parser.add_argument("--seed", type=int, default=RESAMPLING_SEED)
+    stats_parser.add_argument("--confidence", type=float, default=0.95)
+
+    all_parser = subparsers.add_parser("all", help="Run msd, merge, plot and fit")
+    add_common(all_parser)
+    add_msd_options(all_parser)
+    add_plot_options(all_parser)
+    add_fit_options(all_parser)
+
+    args = parser.parse_args(argv)
+    errors = {}
+
+    if args.command == "stats":
+        results = resampling_stats(args.base_dir, _parse_conditions(args.condition), args.metric, args.resamples,
+                                   args.seed, args.confidence, args.statistic, args.output_format)
+        return 0 if len(results) else 1
+
+    if args.command == "ensemble":
+        summary_csvs = combine_ensembles(args.base_dir, _parse_conditions(args.condition))
+        if summary_csvs:
+            labels = [os.path.basename(path)[len("ensemble_msd_"):-len("_summary.csv")] for path in summary_csvs]
+            plot_ensemble_msd(summary_csvs, os.path.join(args.base_dir, "msd_merge", ENSEMBLE_PLOT_NAME), labels,
+                              tuple(args.x_limit) if args.x_limit else None,
+                              tuple(args.y_limit) if args.y_limit else None)
+        return 0 if summary_csvs else 1
+
+    if args.report:
+        enable_instrumentation()
+
+    if args.command in ("msd", "all"):
+        plot_layout = None if args.plot_layout == "none" else args.plot_layout
+        _, errors = process_working_dir(args.base_dir, args.time_interval, args.max_lag, args.chunksize,
+                                        args.workers, method=args.method, incremental=args.incremental,
+                                        output_format=args.output_format, plot_layout=plot_layout,
+                                        profile_file=args.profile, local_window=args.local_window,
+                                        local_lags=args.local_lags, state_threshold=args.state_threshold,
+                                        observables=args.observables, van_hove_lags=tuple(args.van_hove_lags),
+                                        vacf_lags=args.vacf_lags, van_hove_range=args.van_hove_range,
+                                        van_hove_bins=args.van_hove_bins)
+        print("Processing completed.")
+
+    if args.command in ("merge", "plot", "all"):
+        x_limit = tuple(args.x_limit) if getattr(args, "x_limit", None) else None
+        y_limit = tuple(args.y_limit) if getattr(args, "y_limit", None) else None
+        process_subfolders(args.base_dir, x_limit, y_limit, incremental=args.incremental,
+                           output_format=args.output_format, merge=args.command != "plot",
+                           plot=args.command != "merge")
+
+    if args.command in ("fit", "all"):
+        fit_subfolders(args.base_dir, args.fit_lags, args.min_length, output_format=args.output_format)
+
+    if args.report:
+        write_run_report(args.report)
+        print_run_summary()
+
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
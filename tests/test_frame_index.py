@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msd_calculation
+
+
+def _tracks_in_frames(n_frames=12):
+    # POSITION_T in frames, as TrackMate writes it for images without a frame interval
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "TRACK_ID": np.repeat([0, 1], n_frames),
+        "POSITION_T": np.tile(np.arange(n_frames, dtype=float), 2),
+        "POSITION_X": np.cumsum(rng.normal(size=2 * n_frames)),
+        "POSITION_Y": np.cumsum(rng.normal(size=2 * n_frames)),
+        "FRAME": np.tile(np.arange(n_frames), 2),
+    })
+
+
+def test_frame_column_gives_the_lags():
+    df = _tracks_in_frames()
+    table, limits = msd_calculation._compute_msd_table(df, 0.2, "frames", max_lag=5)
+    assert list(limits) == [5, 5]
+    assert np.isfinite(table["msd"]).all()
+    assert np.allclose(table["interval"].values[:6], np.arange(6) * 0.2)
+    assert "FRAME" not in table
+
+
+def test_times_not_in_seconds_are_rejected():
+    df = _tracks_in_frames().drop(columns="FRAME")
+    with pytest.raises(ValueError, match="POSITION_T"):
+        msd_calculation._compute_msd_table(df, 0.2, "frames", max_lag=5)
+
+
+def test_export_without_tracked_spots(tmp_path):
+    # Header-only TrackMate export: every method writes an empty table with the usual columns
+    export = tmp_path / "empty.csv"
+    export.write_text("LABEL,ID,TRACK_ID,FRAME,POSITION_T,POSITION_X,POSITION_Y\n" + "\n" * 4)
+    for method in msd_calculation.MSD_METHODS:
+        for chunksize in (None, 100):
+            path = msd_calculation.make_msd_csv(str(export), 0.2, str(tmp_path / f"{method}_{chunksize}"),
+                                                method=method, chunksize=chunksize)
+            table = pd.read_csv(path)
+            assert len(table) == 0
+            assert list(table.columns) == (msd_calculation.TRACK_COLUMNS + ["interval", "msd"]
+                                           + (["n_pairs"] if method == "frames" else []))
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msd_calculation
+
+
+def _walk(n_frames):
+    rng = np.random.default_rng(0)
+    positions = np.cumsum(rng.normal(size=(n_frames, 2)), axis=0)
+    return positions, np.array([0, n_frames]), np.arange(n_frames)
+
+
+def test_window_shorter_than_twice_the_lags():
+    # window < 2 * lags + 1 used to overrun the row of the local MSD
+    positions, offsets, frame_index = _walk(30)
+    local_D, alpha = msd_calculation._local_msd(positions, offsets, frame_index, 0.2, window=5, lags=4)
+    assert len(alpha) == 30
+    assert np.isfinite(alpha[2:28]).all()
+    assert np.isnan(alpha[:2]).all() and np.isnan(alpha[28:]).all()
+
+
+def test_fewer_frames_than_the_window():
+    positions, offsets, frame_index = _walk(3)
+    local_D, alpha = msd_calculation._local_msd(positions, offsets, frame_index, 0.2, window=9, lags=4)
+    assert np.isnan(local_D).all() and np.isnan(alpha).all()
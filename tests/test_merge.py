@@ -0,0 +1,65 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msd_calculation
+from benchmark_msd import simulate_tracks, write_trackmate_csv
+
+
+def _msd_tables(tmp_path, methods, output_format="csv"):
+    msd_folder = tmp_path / "msd_csv"
+    paths = []
+    for n, method in enumerate(methods):
+        export = tmp_path / f"cells_{n}.csv"
+        write_trackmate_csv(simulate_tracks(20, mean_length=15, seed=n), export, 0.2, shuffle=True, seed=n)
+        paths.append(msd_calculation.make_msd_csv(str(export), 0.2, str(msd_folder), method=method, max_lag=8,
+                                                  output_format=output_format))
+    return str(msd_folder), paths
+
+
+def test_merge_keeps_rows_and_columns(tmp_path):
+    msd_folder, paths = _msd_tables(tmp_path, ["frames", "frames"])
+    merged_file = str(tmp_path / "merged_msd_data.csv")
+    summary = msd_calculation.merge_msd_csvs(msd_folder, merged_file, return_summary=True)
+
+    merged = pd.read_csv(merged_file)
+    tables = [pd.read_csv(path) for path in paths]
+    assert len(merged) == sum(len(table) for table in tables) == summary["rows"].sum()
+    assert list(merged.columns) == list(tables[0].columns) + ["source_file"]
+    for path, table in zip(paths, tables):
+        part = merged[merged["source_file"] == os.path.basename(path)].drop(columns="source_file")
+        pd.testing.assert_frame_equal(part.reset_index(drop=True), table)
+
+
+@pytest.mark.parametrize("output_format", ["csv", "feather"])
+def test_merge_lines_up_tables_with_different_columns(tmp_path, output_format):
+    if output_format != "csv":
+        pytest.importorskip("pyarrow")
+    # batched tables have no n_pairs column, frames tables do
+    msd_folder, paths = _msd_tables(tmp_path, ["batched", "frames"], output_format)
+    merged_file = str(tmp_path / ("merged_msd_data" + msd_calculation.TABLE_FORMATS[output_format]))
+    msd_calculation.merge_msd_csvs(msd_folder, merged_file)
+
+    merged = msd_calculation.read_msd_table(merged_file)
+    batched, frames = (msd_calculation.read_msd_table(path) for path in paths)
+    assert len(merged) == len(batched) + len(frames)
+    assert "n_pairs" in merged.columns
+    from_batched = merged[merged["source_file"] == os.path.basename(paths[0])]
+    from_frames = merged[merged["source_file"] == os.path.basename(paths[1])]
+    assert from_batched["n_pairs"].isna().all()
+    assert np.array_equal(from_frames["n_pairs"].values, frames["n_pairs"].values)
+    assert np.allclose(from_batched["msd"].values, batched["msd"].values)
+    assert np.allclose(from_frames["msd"].values, frames["msd"].values)
+
+
+def test_merge_rejects_non_msd_tables(tmp_path):
+    msd_folder = tmp_path / "msd_csv"
+    msd_folder.mkdir()
+    pd.DataFrame({"TRACK_ID": [0], "POSITION_T": [0.0]}).to_csv(msd_folder / "broken_msd.csv", index=False)
+    with pytest.raises(ValueError, match="missing interval, msd"):
+        msd_calculation.merge_msd_csvs(str(msd_folder), str(tmp_path / "merged_msd_data.csv"))
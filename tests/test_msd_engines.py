@@ -0,0 +1,51 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msd_calculation
+from benchmark_msd import simulate_tracks
+
+METHODS = ["direct", "fft", "batched", "frames"]
+
+
+def _reference(df_tracks, time_interval, max_lag):
+    # Brute-force MSD per track and lag, as {(track, lag): msd}
+    expected = {}
+    for track_id, track in df_tracks.groupby("TRACK_ID"):
+        positions = track[["POSITION_X", "POSITION_Y"]].values
+        limit = int(msd_calculation._lag_limits([len(track)], max_lag)[0])
+        for lag in range(limit + 1):
+            displacements = positions[lag:] - positions[:len(positions) - lag]
+            expected[track_id, lag] = np.mean(np.sum(displacements ** 2, axis=1))
+    return expected
+
+
+@pytest.fixture(scope="module")
+def gap_free_tracks():
+    # Lengths 2..~100: with all lags, the longer tracks go past BY_LAG_MAX to the FFT buckets
+    return simulate_tracks(60, time_interval=0.2, length_distribution="uniform", mean_length=50, seed=5)
+
+
+@pytest.mark.parametrize("method", METHODS)
+@pytest.mark.parametrize("max_lag", [None, 10, 0.5])
+def test_engines_match_brute_force(gap_free_tracks, method, max_lag):
+    table, limits = msd_calculation._compute_msd_table(gap_free_tracks.copy(), 0.2, method, max_lag)
+    expected = _reference(gap_free_tracks, 0.2, max_lag)
+
+    lags = np.rint(table["interval"].values / 0.2).astype(int)
+    assert len(table) == len(expected) == np.sum(limits + 1)
+    assert set(zip(table["TRACK_ID"].values, lags)) == set(expected)
+    reference = np.array([expected[key] for key in zip(table["TRACK_ID"].values, lags)])
+    assert np.allclose(table["msd"].values, reference, rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize("max_lag", [None, 10])
+def test_frames_counts_pairs_on_gap_free_tracks(gap_free_tracks, max_lag):
+    table, _ = msd_calculation._compute_msd_table(gap_free_tracks.copy(), 0.2, "frames", max_lag)
+    lags = np.rint(table["interval"].values / 0.2).astype(int)
+    track_lengths = gap_free_tracks.groupby("TRACK_ID").size()
+    assert np.array_equal(table["n_pairs"].values, track_lengths.loc[table["TRACK_ID"]].values - lags)
@@ -0,0 +1,74 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msd_calculation
+
+
+def _short_track(n_frames=10, time_interval=0.2):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "TRACK_ID": np.zeros(n_frames, dtype=np.int64),
+        "POSITION_T": np.arange(n_frames) * time_interval,
+        "POSITION_X": np.cumsum(rng.normal(size=n_frames)),
+        "POSITION_Y": np.cumsum(rng.normal(size=n_frames)),
+    })
+
+
+def test_vacf_on_track_shorter_than_vacf_lags():
+    # A 10-frame track with the default 20 VACF lags used to raise a broadcast error
+    df = _short_track()
+    observables = msd_calculation.DisplacementObservables(0.2)
+    table, _ = msd_calculation._compute_msd_table(df, 0.2, "frames", observables=observables)
+
+    vacf = observables.vacf_table()
+    assert vacf["lag"].max() == 8
+    assert vacf.loc[vacf["lag"] == 0, "count"].item() == 9
+    assert np.isclose(vacf.loc[vacf["lag"] == 0, "vacf_normalized"].item(), 1.0)
+    assert len(table) == 10
+
+
+def test_vacf_on_single_spot_track():
+    df = _short_track(n_frames=1)
+    observables = msd_calculation.DisplacementObservables(0.2)
+    msd_calculation._compute_msd_table(df, 0.2, "frames", observables=observables)
+    assert len(observables.vacf_table()) == 0
+
+
+def test_rerun_without_observables_removes_their_outputs(tmp_path):
+    export = tmp_path / "cells.csv"
+    _short_track(n_frames=30).to_csv(export, index=False)
+    export.write_text(export.read_text().replace("\n", "\n\n\n\n\n", 1))  # TrackMate's 4 extra header rows
+    msd_folder = tmp_path / "msd_csv"
+    msd_calculation.make_msd_csv(str(export), 0.2, str(msd_folder), observables=("vacf", "ngp"))
+    assert (msd_folder / "cells_vacf.csv").exists() and (msd_folder / "cells_observables.npz").exists()
+
+    msd_calculation.make_msd_csv(str(export), 0.2, str(msd_folder))
+    assert sorted(os.listdir(msd_folder)) == ["cells_msd.csv", "cells_msd.json"]
+    assert msd_calculation.merge_observables(str(msd_folder), str(tmp_path / "msd_merge")) is None
+
+
+def test_van_hove_bins_are_kept_and_checked(tmp_path):
+    df = _short_track(n_frames=40)
+    observables = msd_calculation.DisplacementObservables(0.2, ("van_hove",), van_hove_lags=(1, 8),
+                                                          van_hove_range=20.0, van_hove_bins=40)
+    msd_calculation._compute_msd_table(df, 0.2, "frames", observables=observables)
+    table = observables.van_hove_table()
+    assert len(table) == 2 * 42
+    # Unit-variance steps: nothing falls outside +-20 at lag 8
+    outside = table[np.isinf(table["bin_left"]) | np.isinf(table["bin_right"])]
+    assert outside["count"].sum() == 0
+
+    path = str(tmp_path / "state.npz")
+    observables.save(path)
+    loaded = msd_calculation.DisplacementObservables.load(path)
+    assert (loaded.van_hove_range, loaded.van_hove_bins) == (20.0, 40)
+    assert np.array_equal(loaded.van_hove, observables.van_hove)
+
+    with pytest.raises(ValueError, match="different bins"):
+        loaded.merge(msd_calculation.DisplacementObservables(0.2, ("van_hove",), van_hove_lags=(1, 8)))
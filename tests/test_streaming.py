@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import msd_calculation
+from benchmark_msd import simulate_tracks, write_trackmate_csv
+
+
+@pytest.fixture
+def shuffled_export(tmp_path):
+    # Shuffled TrackMate export with a few spots that belong to no track
+    df = simulate_tracks(40, mean_length=12, seed=3).astype({"TRACK_ID": float})
+    untracked = pd.DataFrame({"TRACK_ID": np.nan, "POSITION_T": [0.2, 0.4, 1.0],
+                              "POSITION_X": [1.0, 2.0, 3.0], "POSITION_Y": [1.0, 2.0, 3.0]})
+    df = pd.concat([df, untracked], ignore_index=True)
+    path = tmp_path / "cells.csv"
+    write_trackmate_csv(df, path, 0.2, shuffle=True, seed=3)
+    return str(path), df["TRACK_ID"].notna().sum()
+
+
+@pytest.mark.parametrize("method", ["frames", "batched"])
+@pytest.mark.parametrize("max_lag", [None, 5])
+def test_chunked_matches_in_memory(tmp_path, monkeypatch, shuffled_export, method, max_lag):
+    export, n_tracked = shuffled_export
+    # Several partitions and chunks even for this small file
+    monkeypatch.setattr(msd_calculation, "TRACKS_PER_PARTITION", 7)
+    in_memory = pd.read_csv(msd_calculation.make_msd_csv(export, 0.2, str(tmp_path / "memory"), method=method,
+                                                         max_lag=max_lag))
+    chunked = pd.read_csv(msd_calculation.make_msd_csv(export, 0.2, str(tmp_path / "chunked"), method=method,
+                                                       max_lag=max_lag, chunksize=50))
+    pd.testing.assert_frame_equal(in_memory, chunked)
+    assert in_memory["TRACK_ID"].notna().all()
+    if max_lag is None and method == "batched":
+        assert len(in_memory) == n_tracked